@@ -0,0 +1,417 @@
+import argparse
+import contextlib
+import gzip
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import Metrics
+from osm_reader import read_json_elements
+from overpass import FileTransport, HttpTransport, OverpassClient
+from route import Route
+from rules import run_rules
+from transfers import find_transfers
+from validation import add_route, chain_routes, is_city_route, make_city, validation
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+CENTER = (118.9, 32.1)  # lon, lat of the synthetic city
+
+
+class NullCity:
+    def warn(self, message, el=None):
+        pass
+
+
+class DictRoute:
+    # Route layout before __slots__: a per-instance dict holding the tag dict
+    def __init__(self, route_id, relation, city):
+        self.city = city
+        self.element = relation
+        self.route_id = route_id
+        self.type = relation['type']
+        self.route = relation['route']
+        self.name = relation['name']
+        self.ref = relation.get('ref', None)
+        self.operator = relation.get('operator', None)
+        self.version = relation.get('public_transport:version', None)
+        self.route_from = relation.get('from', None)
+        self.route_to = relation.get('to', None)
+        self.official_name = ''
+        self.roundtrip = ''
+        self.via = ''
+        self.fee = ''
+        self.charge = ''
+        self.stops = []
+
+
+def scaled_routes(path, scale):
+    # Route relations of the dump repeated `scale` times under new ids. Every
+    # copy is decoded anew, so no strings are shared between copies, as it
+    # would be with a real dump.
+    relations = [
+        el for el in read_json_elements(path)
+        if el['type'] == 'relation' and el.get('tags', {}).get('type') == 'route'
+    ]
+    encoded = [json.dumps(el, ensure_ascii=False) for el in relations]
+    for i in range(scale):
+        for s in encoded:
+            el = json.loads(s)
+            el['id'] += i * 10 ** 9
+            yield el
+
+
+def measure_routes(route_class, path, scale):
+    city = NullCity()
+    tracemalloc.start()
+    routes = [route_class(el['id'], el['tags'], city) for el in scaled_routes(path, scale)]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'routes': len(routes),
+        'retained_bytes': current,
+        'bytes_per_route': current // max(1, len(routes)),
+        'peak_bytes': peak,
+    }
+
+
+def route_templates(path):
+    return [
+        el['tags'] for el in read_json_elements(path)
+        if el['type'] == 'relation' and el.get('tags', {}).get('type') == 'route'
+    ]
+
+
+def synthetic_elements(templates, size, seed=0):
+    # A bus network of about `size` elements in PTv2 form. Every line is a
+    # route_master with two directions over a chain of ways, each stop is a
+    # platform and a stop position in a stop_area, and some stop areas are
+    # joined with a stop area of an earlier line by a stop_area_group.
+    rng = random.Random(seed)
+    ids = itertools.count(1)
+    stop_areas = []
+    count = 0
+    for copy in itertools.count():
+        for tags in templates:
+            if count >= size:
+                return
+            elements = []
+            lon = CENTER[0] + rng.uniform(-0.2, 0.2)
+            lat = CENTER[1] + rng.uniform(-0.2, 0.2)
+            stops = []
+            ways = []
+            prev_position = None
+            for i in range(rng.randint(10, 30)):
+                lon += rng.uniform(-0.004, 0.004)
+                lat += rng.uniform(-0.004, 0.004)
+                name = '{} {}'.format(tags.get('ref', tags.get('name')), i)
+                platform = {
+                    'type': 'node', 'id': next(ids), 'lat': lat + 0.0001, 'lon': lon,
+                    'tags': {'public_transport': 'platform', 'highway': 'bus_stop', 'bus': 'yes', 'name': name},
+                }
+                position = {
+                    'type': 'node', 'id': next(ids), 'lat': lat, 'lon': lon,
+                    'tags': {'public_transport': 'stop_position', 'bus': 'yes', 'name': name},
+                }
+                elements.extend((platform, position))
+                if prev_position is not None:
+                    way_nodes = [prev_position['id']]
+                    for t in (1 / 3, 2 / 3):
+                        node = {
+                            'type': 'node', 'id': next(ids),
+                            'lat': prev_position['lat'] + (lat - prev_position['lat']) * t,
+                            'lon': prev_position['lon'] + (lon - prev_position['lon']) * t,
+                        }
+                        elements.append(node)
+                        way_nodes.append(node['id'])
+                    way_nodes.append(position['id'])
+                    way = {'type': 'way', 'id': next(ids), 'nodes': way_nodes, 'tags': {'highway': 'primary'}}
+                    elements.append(way)
+                    ways.append(way['id'])
+                prev_position = position
+                stop_area = {
+                    'type': 'relation', 'id': next(ids),
+                    'members': [
+                        {'type': 'node', 'ref': position['id'], 'role': 'stop'},
+                        {'type': 'node', 'ref': platform['id'], 'role': 'platform'},
+                    ],
+                    'tags': {'type': 'public_transport', 'public_transport': 'stop_area', 'name': name},
+                }
+                elements.append(stop_area)
+                stops.append((position['id'], platform['id']))
+                if stop_areas and i % 5 == 0:
+                    elements.append({
+                        'type': 'relation', 'id': next(ids),
+                        'members': [
+                            {'type': 'relation', 'ref': stop_area['id'], 'role': ''},
+                            {'type': 'relation', 'ref': rng.choice(stop_areas), 'role': ''},
+                        ],
+                        'tags': {'type': 'public_transport', 'public_transport': 'stop_area_group'},
+                    })
+                stop_areas.append(stop_area['id'])
+
+            ref = '{}-{}'.format(tags.get('ref', ''), copy)
+            routes = []
+            for direction in (1, -1):
+                route_tags = dict(tags, ref=ref)
+                route_tags['public_transport:version'] = '2'
+                if direction < 0:
+                    route_tags['from'], route_tags['to'] = tags.get('to'), tags.get('from')
+                    route_tags = {k: v for k, v in route_tags.items() if v is not None}
+                members = []
+                for position, platform in stops[::direction]:
+                    members.append({'type': 'node', 'ref': position, 'role': 'stop'})
+                    members.append({'type': 'node', 'ref': platform, 'role': 'platform'})
+                members.extend({'type': 'way', 'ref': w, 'role': ''} for w in ways[::direction])
+                route = {'type': 'relation', 'id': next(ids), 'members': members, 'tags': route_tags}
+                elements.append(route)
+                routes.append(route['id'])
+            elements.append({
+                'type': 'relation', 'id': next(ids),
+                'members': [{'type': 'relation', 'ref': r, 'role': ''} for r in routes],
+                'tags': {
+                    'type': 'route_master', 'route_master': 'bus', 'ref': ref,
+                    'name': tags.get('name', ''), 'network': tags.get('network', ''),
+                },
+            })
+            count += len(elements)
+            yield from elements
+
+
+def write_synthetic(path, templates, size):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"version": 0.6, "osm3s": {"timestamp_osm_base": "synthetic"}, "elements": [\n')
+        for i, el in enumerate(synthetic_elements(templates, size)):
+            if i:
+                f.write(',\n')
+            json.dump(el, f, ensure_ascii=False)
+        f.write(']}\n')
+
+
+def run_stage(func, trace_memory):
+    # Wall time of func(), and its peak traced memory when trace_memory is set
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    stats = {'seconds': round(time.perf_counter() - start, 4)}
+    if trace_memory:
+        stats['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    # Peak RSS of the whole process so far, in kilobytes on Linux
+    stats['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result, stats
+
+
+def bench_pipeline_size(path, trace_memory):
+    stages = {}
+
+    def consume(elements):
+        return sum(1 for _ in elements)
+
+    count, stages['load_file'] = run_stage(lambda: consume(read_json_elements(path)), trace_memory)
+    client = OverpassClient(transport=FileTransport(path))
+    _, stages['load_overpass'] = run_stage(lambda: consume(client.query('')), trace_memory)
+
+    elements = list(read_json_elements(path))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        _, stages['validation'] = run_stage(lambda: validation(make_city('1'), elements), trace_memory)
+
+    city = make_city('1')
+
+    def add_all():
+        for el in elements:
+            city.add(el)
+
+    def add_routes():
+        # The same order as in validation()
+        for el in elements:
+            if el['type'] != 'relation':
+                continue
+            if is_city_route(city, el):
+                add_route(city, el)
+            elif el.get('tags', {}).get('type') == 'route_master':
+                city.groups.update_master(el)
+
+    # The stages of validation() one by one
+    _, stages['city_add'] = run_stage(add_all, trace_memory)
+    _, stages['routes'] = run_stage(add_routes, trace_memory)
+    _, stages['way_chains'] = run_stage(lambda: chain_routes(city, list(city.route_by_id), Metrics()), trace_memory)
+    _, stages['transfers'] = run_stage(lambda: find_transfers(city), trace_memory)
+    _, stages['rules'] = run_stage(lambda: run_rules(city, city.rules), trace_memory)
+    return {'elements': count, 'routes': len(city.route_by_id), 'stages': stages}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_pipeline(options):
+    templates = route_templates(options.source)
+    results = {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'trace_memory': options.trace_memory,
+        'sizes': {},
+    }
+    for size in options.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'synthetic.json')
+            write_synthetic(path, templates, size)
+            results['sizes'][str(size)] = bench_pipeline_size(path, options.trace_memory)
+    return results
+
+
+def compare(baseline, results):
+    # Ratio of new to old time for every stage present in both runs
+    ratios = {}
+    for size, run in results['sizes'].items():
+        old = baseline['sizes'].get(size)
+        if not old:
+            continue
+        ratios[size] = {
+            stage: round(stats['seconds'] / old['stages'][stage]['seconds'], 3)
+            for stage, stats in run['stages'].items()
+            if stage in old['stages'] and old['stages'][stage]['seconds'] > 0
+        }
+    return {'baseline': baseline.get('commit'), 'commit': results.get('commit'), 'ratios': ratios}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # A local Overpass API: answers every query with the gzipped source, after
+    # the statuses queued in server.statuses
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests += 1
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = self.server.body if status == 200 else b'Too many requests'
+        self.send_response(status)
+        if status == 200:
+            self.send_header('Content-Encoding', 'gzip')
+        else:
+            self.send_header('Retry-After', '0')
+        if self.server.close_next:
+            self.server.close_next = False
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def bench_overpass(options):
+    # Checks OverpassClient against a local stub: gzip decoding, retry on
+    # 429, reuse of one keep-alive connection, reconnecting after the server
+    # closes it, and a free slot while a response is being parsed
+    with open(options.source, 'rb') as f:
+        source = f.read()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.body = gzip.compress(source)
+    server.statuses = []
+    server.connections = server.requests = 0
+    server.close_next = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/api/interpreter'.format(server.server_address[1])
+    client = OverpassClient(transport=HttpTransport(url), max_concurrent=1, backoff=0)
+    expected = sum(1 for _ in read_json_elements(options.source))
+    checks = {}
+    try:
+        count, stats = run_stage(lambda: sum(1 for _ in client.query('')), options.trace_memory)
+        checks['gzip'] = count == expected
+
+        server.statuses = [429]
+        requests = server.requests
+        checks['retry_429'] = sum(1 for _ in client.query('')) == expected and server.requests == requests + 2
+
+        for _ in range(3):
+            sum(1 for _ in client.query(''))
+        checks['keep_alive'] = server.connections == 1
+
+        server.close_next = True
+        sum(1 for _ in client.query(''))
+        checks['reconnect'] = sum(1 for _ in client.query('')) == expected and server.connections == 2
+
+        elements = client.query('')
+        next(elements)
+        checks['slot_free_while_parsing'] = client.semaphore.acquire(blocking=False)
+        if checks['slot_free_while_parsing']:
+            client.semaphore.release()
+        elements.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        'elements': expected,
+        'gzip_bytes': len(server.body),
+        'requests': server.requests,
+        'connections': server.connections,
+        'query': stats,
+        'checks': checks,
+        'ok': all(checks.values()),
+    }
+
+
+def bench_memory(options):
+    results = {}
+    for name, route_class in (('dict', DictRoute), ('slots', Route)):
+        results[name] = measure_routes(route_class, options.source, options.scale)
+    results['saving'] = 1 - results['slots']['retained_bytes'] / results['dict']['retained_bytes']
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=['memory', 'pipeline', 'overpass', 'compare'], help='Benchmark to run')
+    parser.add_argument('-i', '--source', default='qixia.json', help='OSM JSON to take routes from')
+    parser.add_argument('-s', '--scale', type=int, default=1000, help='How many times to repeat the source')
+    parser.add_argument(
+        '--sizes', type=lambda s: [int(x) for x in s.split(',')], default=DEFAULT_SIZES,
+        help='Comma separated element counts of synthetic cities',
+    )
+    parser.add_argument('--trace-memory', action='store_true', help='Trace peak memory of every stage, slower')
+    parser.add_argument('-o', '--output', help='JSON file for results')
+    parser.add_argument('--baseline', help='Results of an earlier pipeline run')
+    parser.add_argument('--results', help='Results to compare with the baseline')
+    options = parser.parse_args()
+
+    if options.benchmark == 'memory':
+        output = bench_memory(options)
+    elif options.benchmark == 'pipeline':
+        output = bench_pipeline(options)
+    elif options.benchmark == 'overpass':
+        output = bench_overpass(options)
+    else:
+        with open(options.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(options.results, encoding='utf-8') as f:
+            output = compare(baseline, json.load(f))
+    text = json.dumps(output, indent=2)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+    if output.get('ok') is False:
+        sys.exit(1)
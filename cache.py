@@ -0,0 +1,81 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+CACHE_VERSION = 10  # Bump when Route, RouteMaster or City layout changes
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def elements_digest(elements):
+    h = hashlib.blake2b(digest_size=20)
+    for el in elements:
+        h.update(json.dumps(el, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return h.hexdigest()
+
+
+def osm_timestamp(header):
+    return header.get('osm3s', {}).get('timestamp_osm_base') or ''
+
+
+def source_key(path, read_elements):
+    # The snapshot timestamp sits in the envelope before the elements,
+    # so reading the first element is enough to get it
+    header = {}
+    elements = read_elements(path, header)
+    next(elements, None)
+    elements.close()
+    return '{}:{}'.format(osm_timestamp(header), file_digest(path))
+
+
+def elements_key(elements, header):
+    return '{}:{}'.format(osm_timestamp(header), elements_digest(elements))
+
+
+def load_cache(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+        logging.warning('Cannot read cache %s: %s', path, e)
+        return {}
+    if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+        logging.info('Ignoring cache %s made by another version', path)
+        return {}
+    return data['cities']
+
+
+def read_cache(path, city_id, settings=None):
+    # Returns {'key', 'city', 'result', 'settings'} of the last run for the
+    # city, or None. A city validated with other settings (checks to run,
+    # issue caps) cannot be reused.
+    cached = load_cache(path).get(str(city_id))
+    if cached and cached.get('settings') != settings:
+        logging.info('Ignoring cached city %s validated with other settings', city_id)
+        return None
+    return cached
+
+
+def write_cache(path, city_id, key, city, settings=None):
+    cities = load_cache(path)
+    cities[str(city_id)] = {
+        'key': key,
+        'city': city,
+        'result': city.get_validation_result(),
+        'settings': settings,
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'version': CACHE_VERSION, 'cities': cities}, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
@@ -0,0 +1,144 @@
+from array import array
+from collections import defaultdict
+
+from city import el_id
+
+STOP_ROLES = ('stop', 'stop_entry_only', 'stop_exit_only')
+PLATFORM_ROLES = ('platform', 'platform_entry_only', 'platform_exit_only')
+LINE_ROLES = ('', 'forward', 'backward')
+
+
+class Chain:
+    # A route line assembled from its ways: nodes of the line (node ids, or
+    # rounded coordinates when the ways have only geometry), their (lon, lat)
+    # where known, and the problems found on the way
+    __slots__ = ('nodes', 'coords', 'gaps', 'misordered', 'forks')
+
+    def __init__(self):
+        self.nodes = []
+        self.coords = []
+        self.gaps = []  # Way el_ids after which the line breaks off
+        self.misordered = []  # Way el_ids that do not continue the previous one, but a later one does
+        self.forks = []  # Nodes where more than two way ends meet
+
+    @property
+    def by_id(self):
+        # Whether the ways were joined on node ids, not on coordinates
+        return bool(self.nodes) and not isinstance(self.nodes[0], tuple)
+
+
+def member_nodes(elements, m):
+    # (node ids, coords) of a node or way member, from the geometry of
+    # "out geom" output or from elements by el_id. Coords has None for
+    # nodes without a location; either is None when not known.
+    el = elements.get(el_id(m))
+    if m['type'] == 'node':
+        node = m if 'lat' in m else el
+        return [m['ref']], [(node['lon'], node['lat'])] if node and 'lat' in node else None
+    nodes = el.get('nodes') if el else None
+    geometry = m.get('geometry') or (el.get('geometry') if el else None)
+    if geometry:
+        coords = [(p['lon'], p['lat']) if p else None for p in geometry]
+    elif nodes:
+        coords = []
+        for n in nodes:
+            node = elements.get('n{}'.format(n))
+            coords.append((node['lon'], node['lat']) if node and 'lat' in node else None)
+    else:
+        coords = None
+    if nodes and coords and len(coords) != len(nodes):
+        coords = None
+    return nodes, coords
+
+
+def member_coords(elements, m):
+    # Known (lon, lat) of a node or way member
+    _, coords = member_nodes(elements, m)
+    return [c for c in coords if c] if coords else []
+
+
+def route_ways(city, relation):
+    # [(way el_id, keys, coords)] in member order. Ways are joined on node
+    # ids when every way has them, otherwise on coordinates.
+    ways = []
+    for m in relation.get('members', ()):
+        if m['type'] == 'way' and m.get('role', '') in LINE_ROLES:
+            nodes, coords = member_nodes(city.elements, m)
+            if nodes or coords:
+                ways.append((el_id(m), nodes, coords))
+    by_id = all(nodes for _, nodes, _ in ways)
+    result = []
+    for way_id, nodes, coords in ways:
+        if by_id:
+            keys = list(nodes)
+        elif coords and None not in coords:
+            keys = [(round(lon, 7), round(lat, 7)) for lon, lat in coords]
+        else:
+            continue
+        result.append((way_id, keys, coords or [None] * len(keys)))
+    return result
+
+
+def assemble(ways):
+    # Chains ways in member order in one pass, using a map of way end nodes
+    # to tell ways out of order from real gaps
+    chain = Chain()
+    ends = defaultdict(list)  # End node → indices of ways ending there
+    for i, (_, keys, _) in enumerate(ways):
+        ends[keys[0]].append(i)
+        ends[keys[-1]].append(i)
+    chain.forks = [k for k, v in ends.items() if len(v) > 2]
+
+    def orient(i):
+        # A way that starts a line segment goes towards the next way
+        _, keys, coords = ways[i]
+        if i + 1 < len(ways):
+            _, next_keys, _ = ways[i + 1]
+            if keys[-1] not in (next_keys[0], next_keys[-1]) and keys[0] in (next_keys[0], next_keys[-1]):
+                return keys[::-1], coords[::-1]
+        return keys, coords
+
+    for i, (way_id, keys, coords) in enumerate(ways):
+        if not chain.nodes:
+            keys, coords = orient(i)
+            chain.nodes.extend(keys)
+            chain.coords.extend(coords)
+            continue
+        end = chain.nodes[-1]
+        if keys[0] == end:
+            chain.nodes.extend(keys[1:])
+            chain.coords.extend(coords[1:])
+        elif keys[-1] == end:
+            chain.nodes.extend(keys[-2::-1])
+            chain.coords.extend(coords[-2::-1])
+        else:
+            if any(j > i for j in ends[end]):
+                chain.misordered.append(way_id)
+            else:
+                chain.gaps.append(ways[i - 1][0])
+            keys, coords = orient(i)
+            chain.nodes.extend(keys)
+            chain.coords.extend(coords)
+    return chain
+
+
+def route_stops(relation):
+    # Node ids of stop positions in member order, or of platforms when the
+    # route has no stop positions
+    members = relation.get('members', ())
+    for roles in (STOP_ROLES, PLATFORM_ROLES):
+        stops = [m['ref'] for m in members if m['type'] == 'node' and m.get('role') in roles]
+        if stops:
+            return stops
+    return []
+
+
+def route_line(city, relation):
+    return assemble(route_ways(city, relation))
+
+
+def chain_route(city, route, relation):
+    # Fills route.stops from the relation and returns the Chain of its ways.
+    # The line is checked by the route_line and route_geometry rules.
+    route.stops = array('q', route_stops(relation))
+    return route_line(city, relation)
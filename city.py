@@ -3,8 +3,14 @@ import logging
 import math
 import urllib.parse
 import urllib.request
-from css_colours import normalize_colour
 from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from issues import Issue, IssueBucket
+
+from route import Route, RouteGroups, RouteMaster
+from spatial import GridIndex
+from transfers import UnionFind, find_transfers
 
 SPREADSHEET_ID = '1SEW1-NiNOnA2qDwievcxYV1FOaQl1mb1fdeyqAxHu3k'
 MAX_DISTANCE_TO_ENTRANCES = 300  # in meters
@@ -14,6 +20,8 @@ ALLOWED_TRANSFERS_MISMATCH = 0.07  # part of total interchanges count
 ALLOWED_ANGLE_BETWEEN_STOPS = 45  # in degrees
 DISALLOWED_ANGLE_BETWEEN_STOPS = 20  # in degrees
 
+MAX_ISSUES_PER_CODE = 1000  # issue records kept per city for every code
+
 # If an object was moved not too far compared to previous script run,
 # it is likely the same object
 DISPLACEMENT_TOLERANCE = 300  # in meters
@@ -30,16 +38,63 @@ CONSTRUCTION_KEYS = (
     'construction:railway',
     'proposed:railway',
 )
+STATION_RAILWAY_TAGS = {'station', 'halt', 'tram_stop'}
+STOP_PUBLIC_TRANSPORT_TAGS = {'platform', 'stop_position'}
+
+
+def el_id(el):
+    if not el:
+        return None
+    if 'type' not in el:
+        raise Exception('What is this element? {}'.format(el))
+    return el['type'][0] + str(el.get('id', el.get('ref', '')))
+
+
+def format_elid_list(ids):
+    msg = ', '.join(sorted(ids)[:20])
+    if len(ids) > 20:
+        msg += ', ...'
+    return msg
+
+
+def element_kinds(el):
+    # Buckets of City.index an element goes to
+    tags = el.get('tags')
+    if not tags:
+        return []
+    kinds = []
+    if el['type'] == 'relation':
+        if tags.get('type') in ('route', 'route_master'):
+            kinds.append(tags['type'])
+        if tags.get('public_transport') in ('stop_area', 'stop_area_group'):
+            kinds.append(tags['public_transport'])
+    if tags.get('railway') in STATION_RAILWAY_TAGS:
+        kinds.append('station')
+    elif el['type'] == 'node' and tags.get('railway') == 'subway_entrance':
+        kinds.append('subway_entrance')
+    if el['type'] == 'node' and (
+            tags.get('public_transport') in STOP_PUBLIC_TRANSPORT_TAGS
+            or tags.get('highway') == 'bus_stop'
+    ):
+        kinds.append('stop')
+    return kinds
 
 class City:
     def __init__(self, row, overground=False):
-        self.errors = []
-        self.warnings = []
+        self.errors = []  # List of Issue
+        self.warnings = []  # List of Issue
+        self.max_issues = MAX_ISSUES_PER_CODE
+        self.issue_counts = Counter()  # Code → occurrences, including duplicate and dropped ones
+        self.stored_issues = Counter()  # Code → number of Issue records kept
+        self.issue_keys = set()  # Issue.key() of kept records, for deduplication
+        self.issue_bucket = None  # IssueBucket collecting issues, see collect_issues()
+        self.element_issues = {}  # Relation id → IssueBucket of issues raised while processing it
+        self.rules = None  # Names of checks to run, None for all, see rules.run_rules()
         self.name = row[1]
         self.country = row[2]
         self.continent = row[3]
         if not row[0]:
-            self.error('City {} does not have an id'.format(self.name))
+            self.error('City {} does not have an id', args=(self.name,))
         self.id = int(row[0] or '0')
         self.overground = overground
         if not overground:
@@ -77,96 +132,158 @@ class City:
             self.bbox = None
         
         self.elements = {}  # Dict el_id → el
+        self.index = defaultdict(dict)  # Element kind → el_ids in insertion order (values unused), see element_kinds()
+        self.spatial = {}  # Element kind → GridIndex of its nodes, see spatial_index()
         self.stations = defaultdict(list)  # Dict el_id → list of StopAreas
-        self.routes = {}  # Dict route_ref → route
+        self.routes = {}  # Dict (route_master id, network, ref) → RouteMaster, see RouteGroups
+        self.groups = RouteGroups(self)
         self.masters = {}  # Dict el_id of route → route_master
         self.stop_areas = defaultdict(list)  # El_id → list of el_id of stop_area
-        self.transfers = []  # List of lists of stop areas
+        self.interchanges = UnionFind()  # Stop areas and stop_area_groups joined into interchanges
+        self.transfers = []  # List of lists of el_id of stop areas, see find_transfers()
         self.station_ids = set()  # Set of stations' uid
         self.stops_and_platforms = set()  # Set of stops and platforms el_id
         self.recovery_data = None
+        self.route_by_id = {}  # Relation id → Route
+        self.versions = {}  # Relation id → version (or content digest) it was validated at
     
-    def log_message(self, message, el):
-        if el:
-            tags = el.get('tags', {})
-            message += ' ({} {}, "{}")'.format(
-                el['type'],
-                el.get('id', el.get('ref')),
-                tags.get('name', tags.get('ref', '')),
-            )
-        return message
+    def log(self, is_error, message, el=None, args=(), code=None):
+        # message is a format string for args, which must be hashable.
+        # Repeated issues are counted but not kept, and so are issues over
+        # max_issues for their code.
+        code = code or message
+        bucket = self.issue_bucket
+        self.issue_counts[code] += 1
+        if bucket is not None:
+            bucket.counts[code] = bucket.counts.get(code, 0) + 1
+        issue = Issue(code, message, args, Issue.element_ref(el))
+        key = issue.key()
+        if key in self.issue_keys or self.stored_issues[code] >= self.max_issues:
+            return
+        self.issue_keys.add(key)
+        self.stored_issues[code] += 1
+        target = bucket if bucket is not None else self
+        if is_error:
+            target.errors.append(issue)
+        else:
+            target.warnings.append(issue)
     
-    def warn(self, message, el=None):
-        msg = self.log_message(message, el)
-        self.warnings.append(msg)
+    def warn(self, message, el=None, args=(), code=None):
+        self.log(False, message, el, args, code)
     
-    def error(self, message, el=None):
-        msg = self.log_message(message, el)
-        self.errors.append(msg)
+    def error(self, message, el=None, args=(), code=None):
+        self.log(True, message, el, args, code)
     
-    def error_if(self, is_error, message, el=None):
-        if is_error:
-            self.error(message, el)
-        else:
-            self.warn(message, el)
+    def error_if(self, is_error, message, el=None, args=(), code=None):
+        self.log(is_error, message, el, args, code)
+    
+    @contextmanager
+    def collect_issues(self, key):
+        # Issues raised inside are kept apart under key, so that
+        # forget_issues(key) can drop them when the element changes.
+        # Issues collected under the same key again are added to them.
+        bucket = self.element_issues.setdefault(key, IssueBucket())
+        outer, self.issue_bucket = self.issue_bucket, bucket
+        try:
+            yield bucket
+        finally:
+            self.issue_bucket = outer
+    
+    def forget_issues(self, key):
+        bucket = self.element_issues.pop(key, None)
+        if bucket is None:
+            return
+        for issue in bucket.warnings + bucket.errors:
+            self.issue_keys.discard(issue.key())
+            self.stored_issues[issue.code] -= 1
+        self.issue_counts.subtract(bucket.counts)
+    
+    def iter_issues(self, is_error):
+        yield from self.errors if is_error else self.warnings
+        for bucket in self.element_issues.values():
+            yield from bucket.errors if is_error else bucket.warnings
+    
+    def issue_records(self):
+        for is_error, level in ((True, 'error'), (False, 'warning')):
+            for issue in self.iter_issues(is_error):
+                yield issue.as_dict(level)
         
     def add(self, el):
         if el['type'] == 'relation' and 'members' not in el:
             return
-        self.elements[el_id(el)] = el
+        k = el_id(el)
+        for kind in element_kinds(el):
+            if k not in self.elements:
+                self.index[kind][k] = None
+            # A spatial index built before has not got the node
+            self.spatial.pop(kind, None)
+        self.elements[k] = el
+        # Routes in two route_masters and duplicate stop area members are
+        # reported by the route_masters and stop_areas rules
         if el['type'] == 'relation' and 'tags' in el:
             if el['tags'].get('type') == 'route_master':
                 for m in el['members']:
                     if m['type'] == 'relation':
-                        if el_id(m) in self.masters:
-                            self.error('Route in two route_masters', m)
                         self.masters[el_id(m)] = el
             elif el['tags'].get('public_transport') == 'stop_area':
-                warned_about_duplicates = False
                 for m in el['members']:
                     stop_areas = self.stop_areas[el_id(m)]
-                    if el in stop_areas:
-                        if not warned_about_duplicates:
-                            self.warn('Duplicate element in a stop area', el)
-                            warned_about_duplicates = True
-                    else:
+                    if el not in stop_areas:
                         stop_areas.append(el)
     
-    def make_transfer(self, sag):
-        transfer = set()
-        for m in sag['members']:
-            k = el_id(m)
-            el = self.elements.get(k)
-            if not el:
-                # A sag member may validly not belong to the city while
-                # the sag does - near the city bbox boundary
+    def remove(self, *keys):
+        # Drops elements added with add(), e.g. when they are deleted in OSM
+        orphans = set()  # El_ids of routes that lost their route_master
+        for k in keys:
+            el = self.elements.pop(k, None)
+            if el is None:
                 continue
-            if 'tags' not in el:
-                self.error('An untagged object {} in a stop_area_group'.format(k), sag)
-                continue
-            if (
-                    el['type'] != 'relation'
-                    or el['tags'].get('type') != 'public_transport'
-                    or el['tags'].get('public_transport') != 'stop_area'
-            ):
-                continue
-            if k in self.stations:
-                stoparea = self.stations[k][0]
-                transfer.add(stoparea)
-                if stoparea.transfer:
-                    self.error('Stop area {} belongs to multiple interchanges'.format(k))
-                stoparea.transfer = el_id(sag)
-        if len(transfer) > 1:
-            self.transfers.append(transfer)
+            for kind in element_kinds(el):
+                self.index[kind].pop(k, None)
+                self.spatial.pop(kind, None)
+            if el['type'] == 'relation' and 'tags' in el:
+                for m in el['members']:
+                    if self.masters.get(el_id(m)) is el:
+                        del self.masters[el_id(m)]
+                        orphans.add(el_id(m))
+                    stop_areas = self.stop_areas.get(el_id(m))
+                    if stop_areas and el in stop_areas:
+                        stop_areas.remove(el)
+        if orphans:
+            # A route may still be in another route_master
+            for master in self.iter_kind('route_master'):
+                for m in master['members']:
+                    if el_id(m) in orphans:
+                        self.masters.setdefault(el_id(m), master)
+
+    def iter_kind(self, kind):
+        for k in self.index[kind]:
+            yield self.elements[k]
+    
+    def spatial_index(self, kind):
+        # Built on first use, elements should all be added by then
+        if kind not in self.spatial:
+            nodes = [el for el in self.iter_kind(kind) if el['type'] == 'node' and 'lat' in el]
+            if self.bbox:
+                lat0 = (self.bbox[1] + self.bbox[3]) / 2
+            elif nodes:
+                lat0 = sum(el['lat'] for el in nodes) / len(nodes)
+            else:
+                lat0 = 0.0
+            index = GridIndex(MAX_DISTANCE_TO_ENTRANCES, lat0)
+            for el in nodes:
+                index.insert(el_id(el), el['lon'], el['lat'])
+            self.spatial[kind] = index
+        return self.spatial[kind]
     
     def extract_routes(self):
         # Extract stations
         processed_stop_areas = set()
-        for el in self.elements.values():
+        for el in self.iter_kind('station'):
             if Station.is_station(el, self.modes):
                 # See PR https://github.com/mapsme/subways/pull/98
                 if el['type'] == 'relation' and el['tags'].get('type') != 'multipolygon':
-                    self.error("A railway station cannot be a relation of type '{}'".format(el['tags'].get('type')),el,)
+                    self.error("A railway station cannot be a relation of type '{}'", el, args=(el['tags'].get('type'),))
                     continue
                 st = Station(el, self)
                 self.station_ids.add(st.id)
@@ -188,13 +305,14 @@ class City:
                             if sp in self.stops_and_platforms:
                                 self.warn(
                                     'A stop or a platform {} belongs to multiple '
-                                    'stations, might be correct'.format(sp)
+                                    'stations, might be correct',
+                                    args=(sp,),
                                 )
                             else:
                                 self.stops_and_platforms.add(sp)
         
         # Extract routes
-        for el in self.elements.values():
+        for el in self.iter_kind('route'):
             if Route.is_route(el, self.modes):
                 if el['tags'].get('access') in ('no', 'private'):
                     continue
@@ -209,49 +327,29 @@ class City:
                     if network not in self.networks and master_network not in self.networks:
                         continue
                 
-                route = Route(el, self, master)
-                k = el_id(master) if master else route.ref
-                if k not in self.routes:
-                    self.routes[k] = RouteMaster(master)
-                self.routes[k].add(route, self)
-                
-                # Sometimes adding a route to a newly initialized RouteMaster can fail
-                if len(self.routes[k]) == 0:
-                    del self.routes[k]
-            
-            # And while we're iterating over relations, find interchanges
-            if (
-                    el['type'] == 'relation'
-                    and el.get('tags', {}).get('public_transport', None)
-                    == 'stop_area_group'
-            ):
-                self.make_transfer(el)
+                route = Route(el['id'], el['tags'], self)
+                self.route_by_id[route.route_id] = route
+                self.groups.add(route)
         
-        # Filter transfers, leaving only stations that belong to routes
-        used_stop_areas = set()
-        for rmaster in self.routes.values():
-            for route in rmaster:
-                used_stop_areas.update([s.stoparea for s in route.stops])
-        new_transfers = []
-        for transfer in self.transfers:
-            new_tr = [s for s in transfer if s in used_stop_areas]
-            if len(new_tr) > 1:
-                new_transfers.append(new_tr)
-        self.transfers = new_transfers
+        # Find interchanges
+        find_transfers(self)
     
     def __iter__(self):
         return iter(self.routes.values())
     
     def is_good(self):
-        return len(self.errors) == 0
+        return next(self.iter_issues(True), None) is None
     
     def get_validation_result(self):
         result = {
+            'id': self.id,
             'name': self.name,
             'country': self.country,
             'continent': self.continent,
             'stations_found': getattr(self, 'found_stations', 0),
             'transfers_found': getattr(self, 'found_interchanges', 0),
+            'network_components': getattr(self, 'network_components', 0),
+            'isolated_routes': getattr(self, 'isolated_routes', 0),
             'unused_entrances': getattr(self, 'unused_entrances', 0),
             'networks': getattr(self, 'found_networks', 0),
         }
@@ -283,190 +381,7 @@ class City:
                     'otherl_found': getattr(self, 'found_other_lines', 0),
                 }
             )
-        result['warnings'] = self.warnings
-        result['errors'] = self.errors
+        result['warnings'] = [str(i) for i in self.iter_issues(False)]
+        result['errors'] = [str(i) for i in self.iter_issues(True)]
+        result['issue_counts'] = {k: v for k, v in self.issue_counts.items() if v > 0}
         return result
-    
-    def count_unused_entrances(self):
-        global used_entrances
-        stop_areas = set()
-        for el in self.elements.values():
-            if (
-                    el['type'] == 'relation'
-                    and 'tags' in el
-                    and el['tags'].get('public_transport') == 'stop_area'
-                    and 'members' in el
-            ):
-                stop_areas.update([el_id(m) for m in el['members']])
-        unused = []
-        not_in_sa = []
-        for el in self.elements.values():
-            if (
-                    el['type'] == 'node'
-                    and 'tags' in el
-                    and el['tags'].get('railway') == 'subway_entrance'
-            ):
-                i = el_id(el)
-                if i in self.stations:
-                    used_entrances.add(i)
-                if i not in stop_areas:
-                    not_in_sa.append(i)
-                    if i not in self.stations:
-                        unused.append(i)
-        self.unused_entrances = len(unused)
-        self.entrances_not_in_stop_areas = len(not_in_sa)
-        if unused:
-            self.warn('Found {} entrances not used in routes or stop_areas: {}'.format(
-                len(unused), format_elid_list(unused)
-            )
-            )
-        if not_in_sa:
-            self.warn('{} subway entrances are not in stop_area relations: {}'.format(
-                len(not_in_sa), format_elid_list(not_in_sa)
-            )
-            )
-    
-    def check_return_routes(self, rmaster):
-        variants = {}
-        have_return = set()
-        for variant in rmaster:
-            if len(variant) < 2:
-                continue
-            # Using transfer ids because a train can arrive at different stations within a transfer
-            # But disregard transfer that may give an impression of a circular route
-            # (for example, Simonis / Elisabeth station and route 2 in Brussels)
-            if variant[0].stoparea.transfer == variant[-1].stoparea.transfer:
-                t = (variant[0].stoparea.id, variant[-1].stoparea.id)
-            else:
-                t = (
-                    variant[0].stoparea.transfer or variant[0].stoparea.id,
-                    variant[-1].stoparea.transfer or variant[-1].stoparea.id,
-                )
-            if t in variants:
-                continue
-            variants[t] = variant.element
-            tr = (t[1], t[0])
-            if tr in variants:
-                have_return.add(t)
-                have_return.add(tr)
-        
-        if len(variants) == 0:
-            self.error(
-                'An empty route master {}. Please set construction:route '
-                'if it is under construction'.format(rmaster.id)
-            )
-        elif len(variants) == 1:
-            self.error_if(
-                not rmaster.best.is_circular,
-                'Only one route in route_master. '
-                'Please check if it needs a return route',
-                rmaster.best.element,
-            )
-        else:
-            for t, rel in variants.items():
-                if t not in have_return:
-                    self.warn('Route does not have a return direction', rel)
-    
-    def validate_lines(self):
-        self.found_light_lines = len(
-            [x for x in self.routes.values() if x.mode != 'subway']
-        )
-        self.found_lines = len(self.routes) - self.found_light_lines
-        if self.found_lines != self.num_lines:
-            self.error(
-                'Found {} subway lines, expected {}'.format(
-                    self.found_lines, self.num_lines
-                )
-            )
-        if self.found_light_lines != self.num_light_lines:
-            self.error(
-                'Found {} light rail lines, expected {}'.format(
-                    self.found_light_lines, self.num_light_lines
-                )
-            )
-    
-    def validate_overground_lines(self):
-        self.found_tram_lines = len(
-            [x for x in self.routes.values() if x.mode == 'tram']
-        )
-        self.found_bus_lines = len(
-            [x for x in self.routes.values() if x.mode == 'bus']
-        )
-        self.found_trolleybus_lines = len(
-            [x for x in self.routes.values() if x.mode == 'trolleybus']
-        )
-        self.found_other_lines = len(
-            [
-                x
-                for x in self.routes.values()
-                if x.mode not in ('bus', 'trolleybus', 'tram')
-            ]
-        )
-        if self.found_tram_lines != self.num_tram_lines:
-            self.error_if(
-                self.found_tram_lines == 0,
-                'Found {} tram lines, expected {}'.format(
-                    self.found_tram_lines, self.num_tram_lines
-                ),
-                )
-    
-    def validate(self):
-        networks = Counter()
-        self.found_stations = 0
-        unused_stations = set(self.station_ids)
-        for rmaster in self.routes.values():
-            networks[str(rmaster.network)] += 1
-            if not self.overground:
-                self.check_return_routes(rmaster)
-            route_stations = set()
-            for sa in rmaster.stop_areas():
-                route_stations.add(sa.transfer or sa.id)
-                unused_stations.discard(sa.station.id)
-            self.found_stations += len(route_stations)
-        if unused_stations:
-            self.unused_stations = len(unused_stations)
-            self.warn(
-                '{} unused stations: {}'.format(
-                    self.unused_stations, format_elid_list(unused_stations)
-                )
-            )
-        self.count_unused_entrances()
-        self.found_interchanges = len(self.transfers)
-        
-        if self.overground:
-            self.validate_overground_lines()
-        else:
-            self.validate_lines()
-            
-            if self.found_stations != self.num_stations:
-                msg = 'Found {} stations in routes, expected {}'.format(
-                    self.found_stations, self.num_stations
-                )
-                self.error_if(
-                    not (
-                            0
-                            <= (self.num_stations - self.found_stations)
-                            / self.num_stations
-                            <= ALLOWED_STATIONS_MISMATCH
-                    ),
-                    msg,
-                )
-            
-            if self.found_interchanges != self.num_interchanges:
-                msg = 'Found {} interchanges, expected {}'.format(self.found_interchanges, self.num_interchanges)
-                self.error_if(
-                    self.num_interchanges != 0
-                    and not (
-                            (self.num_interchanges - self.found_interchanges)
-                            / self.num_interchanges
-                            <= ALLOWED_TRANSFERS_MISMATCH
-                    ),
-                    msg,
-                    )
-        
-        self.found_networks = len(networks)
-        if len(networks) > max(1, len(self.networks)):
-            n_str = '; '.join(
-                ['{} ({})'.format(k, v) for k, v in networks.items()]
-            )
-            self.warn('More than one network: {}'.format(n_str))
\ No newline at end of file
@@ -0,0 +1,120 @@
+import json
+import math
+
+from chain import PLATFORM_ROLES, STOP_ROLES, member_coords, route_line
+from city import el_id
+
+DEGREE = math.radians(1) * 6378137.0  # meters in a degree of latitude
+
+
+def route_geometry(city, route, crude=False):
+    # Returns the route line and [(stop el_id, (lon, lat))]
+    relation = city.elements.get('r{}'.format(route.route_id))
+    members = relation.get('members', []) if relation else []
+    stops = []
+    if len(route.stops):
+        for node_id in route.stops:
+            coords = member_coords(city.elements, {'type': 'node', 'ref': node_id})
+            if coords:
+                stops.append(('n{}'.format(node_id), coords[0]))
+    else:
+        for roles in (STOP_ROLES, PLATFORM_ROLES):
+            for m in members:
+                if m['type'] == 'node' and m.get('role') in roles:
+                    coords = member_coords(city.elements, m)
+                    if coords:
+                        stops.append((el_id(m), coords[0]))
+            if stops:
+                break
+    if crude:
+        line = [c for _, c in stops]
+    else:
+        line = [c for c in route_line(city, relation).coords if c] if relation else []
+        line = line or [c for _, c in stops]
+    return line, stops
+
+
+def segment_distance(p, a, b, kx):
+    # Distance in meters from p to segment ab, coordinates in degrees
+    px, py = (p[0] - a[0]) * kx, (p[1] - a[1]) * DEGREE
+    bx, by = (b[0] - a[0]) * kx, (b[1] - a[1]) * DEGREE
+    length2 = bx * bx + by * by
+    t = 0.0 if length2 == 0 else max(0.0, min(1.0, (px * bx + py * by) / length2))
+    return math.hypot(px - t * bx, py - t * by)
+
+
+def simplify(line, tolerance):
+    # Douglas-Peucker with an explicit stack, tolerance in meters
+    if tolerance <= 0 or len(line) < 3:
+        return line
+    kx = DEGREE * math.cos(math.radians(line[0][1]))
+    keep = [False] * len(line)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(line) - 1)]
+    while stack:
+        first, last = stack.pop()
+        best, index = 0.0, None
+        for i in range(first + 1, last):
+            d = segment_distance(line[i], line[first], line[last], kx)
+            if d > best:
+                best, index = d, i
+        if index is not None and best > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(line, keep) if k]
+
+
+def quantize(line, precision):
+    result = []
+    for lon, lat in line:
+        p = [round(lon, precision), round(lat, precision)]
+        if not result or result[-1] != p:
+            result.append(p)
+    return result
+
+
+def route_properties(route):
+    return {
+        'kind': 'route',
+        'id': route.route_id,
+        'mode': route.route,
+        'ref': route.ref,
+        'name': route.name,
+        'network': route.network,
+        'operator': route.operator,
+        'from': route.route_from,
+        'to': route.route_to,
+    }
+
+
+def write_geojson(city, f, crude=False, tolerance=0, precision=6):
+    # Writes a FeatureCollection of route lines and their stops one feature
+    # at a time. With crude, lines go straight from stop to stop.
+    f.write('{"type": "FeatureCollection", "features": [\n')
+    first = True
+    written_stops = set()
+
+    def write_feature(geometry, properties):
+        nonlocal first
+        if not first:
+            f.write(',\n')
+        first = False
+        json.dump({'type': 'Feature', 'geometry': geometry, 'properties': properties}, f, ensure_ascii=False)
+
+    for rmaster in city:
+        for route in rmaster:
+            line, stops = route_geometry(city, route, crude)
+            line = quantize(simplify(line, tolerance), precision)
+            if len(line) >= 2:
+                write_feature({'type': 'LineString', 'coordinates': line}, route_properties(route))
+            for stop_id, coords in stops:
+                if stop_id in written_stops:
+                    continue
+                written_stops.add(stop_id)
+                stop = city.elements.get(stop_id, {})
+                write_feature(
+                    {'type': 'Point', 'coordinates': quantize([coords], precision)[0]},
+                    {'kind': 'stop', 'id': stop_id, 'name': stop.get('tags', {}).get('name')},
+                )
+    f.write('\n]}\n')
@@ -0,0 +1,103 @@
+import numpy as np
+
+from city import (
+    ALLOWED_ANGLE_BETWEEN_STOPS,
+    DISALLOWED_ANGLE_BETWEEN_STOPS,
+    DISPLACEMENT_TOLERANCE,
+    MAX_DISTANCE_STOP_TO_LINE,
+    el_id,
+)
+
+EARTH_RADIUS = 6378137.0  # in meters
+STOP_CHUNK = 256  # stops projected at once, bounds the (stops × segments) arrays
+
+
+def to_meters(coords, lat0=None):
+    # (lon, lat) pairs to an equirectangular plane around lat0, good enough
+    # at city scale
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    if lat0 is None:
+        lat0 = coords[:, 1].mean() if len(coords) else 0.0
+    rad = np.radians(coords)
+    return np.column_stack((rad[:, 0] * np.cos(np.radians(lat0)), rad[:, 1])) * EARTH_RADIUS
+
+
+def project_on_line(line, points):
+    # For every point returns the distance to the polyline and the position
+    # of its projection along the polyline, both in the units of the input
+    distances = np.empty(len(points))
+    positions = np.zeros(len(points))
+    if len(line) == 1:
+        distances[:] = np.hypot(*(points - line[0]).T)
+        return distances, positions
+    a = line[:-1]
+    d = line[1:] - a
+    seg_len2 = (d ** 2).sum(axis=1)
+    seg_len = np.sqrt(seg_len2)
+    offsets = np.concatenate(([0.0], np.cumsum(seg_len)[:-1]))
+    safe_len2 = np.where(seg_len2 > 0, seg_len2, 1.0)
+    for start in range(0, len(points), STOP_CHUNK):
+        p = points[start:start + STOP_CHUNK, None, :]
+        t = np.clip(((p - a) * d).sum(axis=2) / safe_len2, 0.0, 1.0)
+        dist2 = ((p - (a + t[..., None] * d)) ** 2).sum(axis=2)
+        best = dist2.argmin(axis=1)
+        rows = np.arange(len(best))
+        distances[start:start + len(best)] = np.sqrt(dist2[rows, best])
+        positions[start:start + len(best)] = offsets[best] + t[rows, best] * seg_len[best]
+    return distances, positions
+
+
+def stop_angles(points):
+    # Angle at every inner stop between the previous and the next stop,
+    # 180 for a straight line; NaN where two stops coincide
+    v1 = points[:-2] - points[1:-1]
+    v2 = points[2:] - points[1:-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos = (v1 * v2).sum(axis=1) / (np.hypot(*v1.T) * np.hypot(*v2.T))
+    return np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+
+
+def stop_coords(city, route):
+    # Stop ids and (lon, lat) of route stops that are present in the city
+    ids = []
+    coords = []
+    for node_id in route.stops:
+        el = city.elements.get('n{}'.format(node_id))
+        if el and 'lat' in el:
+            ids.append(node_id)
+            coords.append((el['lon'], el['lat']))
+    return ids, coords
+
+
+def check_route_geometry(city, route, line, check_order=True):
+    # line is a sequence of (lon, lat) of the route path, stops are the
+    # route.stops present in city.elements. check_order is off when the
+    # order was checked on node ids already.
+    ids, stops = stop_coords(city, route)
+    if not len(stops) or not len(line):
+        return
+    lat0 = np.asarray(line, dtype=np.float64).reshape(-1, 2)[:, 1].mean()
+    line_m = to_meters(line, lat0)
+    stops_m = to_meters(stops, lat0)
+
+    distances, positions = project_on_line(line_m, stops_m)
+    for i in np.flatnonzero(distances > MAX_DISTANCE_STOP_TO_LINE):
+        city.error(
+            'Stop {} is {:.0f} meters from the route line',
+            route.element,
+            args=(el_id({'type': 'node', 'id': ids[i]}), float(distances[i])),
+        )
+    # A circular route comes back to its start, positions wrap there. A stop
+    # beside a bend may project a bit behind the previous one, so only going
+    # back by more than DISPLACEMENT_TOLERANCE counts.
+    if check_order and ids[0] != ids[-1] and np.any(np.diff(positions) < -DISPLACEMENT_TOLERANCE):
+        city.warn('Stops are not in order along the route line', route.element)
+
+    angles = stop_angles(stops_m)
+    for i in np.flatnonzero(angles < ALLOWED_ANGLE_BETWEEN_STOPS):
+        city.error_if(
+            angles[i] < DISALLOWED_ANGLE_BETWEEN_STOPS,
+            'Angle between stops around {} is too narrow, {:.0f} degrees',
+            route.element,
+            args=(el_id({'type': 'node', 'id': ids[i + 1]}), float(angles[i])),
+        )
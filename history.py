@@ -0,0 +1,205 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import time
+
+BATCH_SIZE = 5000  # rows buffered before an executemany
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    source TEXT
+);
+CREATE TABLE IF NOT EXISTS cities (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    city_id INTEGER NOT NULL,
+    name TEXT,
+    warnings INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (city_id, run_id)
+);
+CREATE TABLE IF NOT EXISTS routes (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    city_id INTEGER NOT NULL,
+    route_id INTEGER NOT NULL,
+    ref TEXT,
+    name TEXT,
+    network TEXT,
+    stops INTEGER NOT NULL,
+    warnings INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    PRIMARY KEY (city_id, route_id, run_id)
+);
+CREATE TABLE IF NOT EXISTS issues (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    city_id INTEGER NOT NULL,
+    level TEXT NOT NULL,
+    code TEXT,
+    element TEXT,
+    message TEXT NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS issues_run ON issues (city_id, run_id, fingerprint);
+'''
+
+
+def fingerprint(issue):
+    # The same issue in two runs has the same fingerprint, even when counts
+    # or distances in its message change: only the level, code, element and
+    # element ids among args are hashed. Records without a code, see
+    # issue_records(), have only their message.
+    parts = [issue.get('level'), issue.get('code'), issue.get('element')]
+    parts.extend(issue.get('refs') or ())
+    if not issue.get('code'):
+        parts.append(issue.get('message'))
+    key = '\0'.join(str(p or '') for p in parts)
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=12).hexdigest()
+
+
+def route_rows(city):
+    # (route id, ref, name, network, stops, warnings, errors) of every route,
+    # small enough to send back from a worker process
+    rows = []
+    for route_id, route in city.route_by_id.items():
+        bucket = city.element_issues.get(route_id)
+        rows.append((
+            route_id, route.ref, route.name, route.network, len(route.stops),
+            len(bucket.warnings) if bucket else 0,
+            len(bucket.errors) if bucket else 0,
+        ))
+    return rows
+
+
+def issue_records(result):
+    # Issue records from a result without them, as plain messages
+    for level, key in (('error', 'errors'), ('warning', 'warnings')):
+        for message in result.get(key, ()):
+            yield {'level': level, 'code': None, 'element': None, 'message': message}
+
+
+class History:
+    # Results of every run in SQLite. A run is one transaction: rows are
+    # buffered and written with executemany, and only a finished run is
+    # committed.
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.run_id = None
+        self.pending = {'cities': [], 'routes': [], 'issues': []}
+
+    def start_run(self, source=None):
+        self.db.execute('BEGIN')
+        started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        self.run_id = self.db.execute(
+            'INSERT INTO runs (started, source) VALUES (?, ?)', (started, source),
+        ).lastrowid
+        return self.run_id
+
+    def add_city(self, result, records=None, routes=()):
+        # records are issue records as in City.issue_records(), routes are
+        # route_rows(); without records the result messages are stored
+        if records is None:
+            records = issue_records(result)
+        run_id, city_id = self.run_id, result['id']
+        self.pending['cities'].append((
+            run_id, city_id, result.get('name'),
+            len(result.get('warnings', ())), len(result.get('errors', ())),
+            json.dumps(result, ensure_ascii=False),
+        ))
+        self.pending['routes'].extend((run_id, city_id) + tuple(row) for row in routes)
+        self.pending['issues'].extend(
+            (run_id, city_id, r['level'], r['code'], r['element'], r['message'], fingerprint(r))
+            for r in records
+        )
+        if sum(len(rows) for rows in self.pending.values()) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany('INSERT OR REPLACE INTO cities VALUES (?, ?, ?, ?, ?, ?)', self.pending['cities'])
+        self.db.executemany('INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', self.pending['routes'])
+        self.db.executemany('INSERT INTO issues VALUES (?, ?, ?, ?, ?, ?, ?)', self.pending['issues'])
+        for rows in self.pending.values():
+            rows.clear()
+
+    def finish_run(self):
+        self.flush()
+        self.db.execute('COMMIT')
+        self.run_id = None
+
+    def close(self):
+        if self.run_id is not None:
+            self.db.execute('ROLLBACK')
+            self.run_id = None
+        self.db.close()
+
+    def city_runs(self, city_id, limit=2):
+        # Ids of the latest runs that have the city, newest first
+        rows = self.db.execute(
+            'SELECT run_id FROM cities WHERE city_id = ? ORDER BY run_id DESC LIMIT ?', (city_id, limit),
+        )
+        return [r[0] for r in rows]
+
+    def new_issues(self, city_id, run_id=None):
+        # Issues of a run (the latest by default) that the previous run of
+        # the city did not have, as (level, code, element, message)
+        runs = self.city_runs(city_id, 1) if run_id is None else [run_id]
+        if not runs:
+            return []
+        previous = self.db.execute(
+            'SELECT MAX(run_id) FROM cities WHERE city_id = ? AND run_id < ?', (city_id, runs[0]),
+        ).fetchone()[0]
+        return self.db.execute(
+            'SELECT level, code, element, message FROM issues AS i '
+            'WHERE city_id = ? AND run_id = ? AND NOT EXISTS ('
+            'SELECT 1 FROM issues AS p WHERE p.city_id = i.city_id AND p.run_id = ? '
+            'AND p.fingerprint = i.fingerprint)',
+            (city_id, runs[0], previous),
+        ).fetchall()
+
+    def route_history(self, city_id, route_id):
+        # (run id, started, warnings, errors) of the route in every run
+        return self.db.execute(
+            'SELECT r.run_id, runs.started, r.warnings, r.errors FROM routes AS r '
+            'JOIN runs ON runs.id = r.run_id WHERE r.city_id = ? AND r.route_id = ? ORDER BY r.run_id',
+            (city_id, route_id),
+        ).fetchall()
+
+    def failing_since(self, city_id, route_id):
+        # The run since which the route has errors in every run, or None
+        since = None
+        for run_id, started, _, errors in self.route_history(city_id, route_id):
+            if not errors:
+                since = None
+            elif since is None:
+                since = (run_id, started)
+        return since
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the validation history made with main.py --history')
+    parser.add_argument('history', help='SQLite history file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    new = subparsers.add_parser('new-issues', help='Issues of the last run of a city that the run before did not have')
+    new.add_argument('city', type=int)
+    new.add_argument('--run', type=int, help='Compare this run instead of the last one')
+    route = subparsers.add_parser('route', help='Warning and error counts of a route over all runs')
+    route.add_argument('city', type=int)
+    route.add_argument('route', type=int)
+    options = parser.parse_args()
+
+    history = History(options.history)
+    if options.command == 'new-issues':
+        for level, code, element, message in history.new_issues(options.city, options.run):
+            print('{}\t{}\t{}'.format(level, element or '', message))
+    else:
+        for run_id, started, warnings, errors in history.route_history(options.city, options.route):
+            print('{}\t{}\t{} warnings\t{} errors'.format(run_id, started, warnings, errors))
+        since = history.failing_since(options.city, options.route)
+        if since:
+            print('Failing since run {} at {}'.format(*since))
+    history.close()
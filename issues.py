@@ -0,0 +1,58 @@
+import re
+
+EL_ID = re.compile(r'[nwr]\d+')
+
+
+class Issue:
+    # A warning or an error as a compact record. The message is a format
+    # string, it is only formatted when the issue is written out.
+    __slots__ = ('code', 'message', 'args', 'el')
+
+    def __init__(self, code, message, args=(), el=None):
+        self.code = code
+        self.message = message
+        self.args = args
+        self.el = el  # (type, id, name) of the element, or None
+
+    @staticmethod
+    def element_ref(el):
+        if not el:
+            return None
+        tags = el.get('tags', {})
+        return el['type'], el.get('id', el.get('ref')), tags.get('name', tags.get('ref', ''))
+
+    def key(self):
+        return self.code, self.el[:2] if self.el else None, self.args
+
+    def refs(self):
+        # Element ids among args. With the code and the element they tell
+        # the issue apart from others; counts and distances do not.
+        return [a for a in self.args if isinstance(a, str) and EL_ID.fullmatch(a)]
+
+    def __str__(self):
+        message = self.message.format(*self.args) if self.args else self.message
+        if self.el:
+            message += ' ({} {}, "{}")'.format(*self.el)
+        return message
+
+    def as_dict(self, level):
+        return {
+            'level': level,
+            'code': self.code,
+            'element': '{}{}'.format(self.el[0][0], self.el[1]) if self.el else None,
+            'refs': self.refs(),
+            'message': str(self),
+        }
+
+    def __repr__(self):
+        return 'Issue({!r}, {!r})'.format(self.code, str(self))
+
+
+class IssueBucket:
+    # Issues raised while processing one element, see City.collect_issues()
+    __slots__ = ('warnings', 'errors', 'counts')
+
+    def __init__(self):
+        self.warnings = []
+        self.errors = []
+        self.counts = {}  # Code → occurrences, including dropped ones
@@ -8,66 +8,223 @@ import time
 import urllib.parse
 import urllib.request
 
-from validation import validation
-
-
-def overpass_request(overpass_api, city_relation_id):
-    city_relation_id = 12601507
-    query = '[out:json][timeout:1000];(relation({});map_to_area;'.format(city_relation_id)
-    query += 'rel[type=route][route=bus](area););out tags qt;'
-    logging.debug('Query: %s', query)
-
-    logging.debug('Query: %s', query)
-    url = '{}?data={}'.format(overpass_api, urllib.parse.quote(query))
-    response = urllib.request.urlopen(url, timeout=1000)
-    if response.getcode() != 200:
-        raise Exception('Failed to query Overpass API: HTTP {}'.format(response.getcode()))
-    return json.load(response)['elements']
+from cache import elements_key, file_digest, read_cache, source_key, write_cache
+from geojson_export import write_geojson
+from history import History, route_rows
+from metrics import Metrics, metrics_path, profile_path, write_metrics
+from multi_city import cities_from_ids, read_city_table, validate_cities
+from osm_reader import read_json_elements, read_xml_elements, write_json_elements
+from overpass import overpass_request
+from partition import partitioned_elements
+from recovery import Recovery
+from rules import select_rules
+from service import CityStore, make_server
+from snapshot import Snapshot, write_snapshot
+from validation import make_city, revalidation, validation
+from validation_log import ValidationLog
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--source', help='File to write backup of OSM data, or to read data from')
     parser.add_argument('-x', '--xml', help='OSM extract with routes, to read data from')
-    parser.add_argument('--overpass-api', default='http://overpass-api.de/api/interpreter', help="Overpass API URL")
+    parser.add_argument('-s', '--snapshot', help='Binary city snapshot made with --dump, to read data from')
+    parser.add_argument('--overpass-api', default='http://overpass-api.de/api/interpreter', help='Overpass API URL, or file://path of a saved response')
+    parser.add_argument('--full', action='store_true', help='Download route members and geometry, not only tags')
+    parser.add_argument('--bbox', help='south,west,north,east of the city, for --tile-size')
+    parser.add_argument('--tile-size', type=float, help='Download the city bbox in tiles of this many degrees')
+    parser.add_argument('--partition', action='store_true', help='Process --tile-size tiles in worker processes, only stops and relations are merged; --source is a directory of tiles')
     parser.add_argument('-q', '--quiet', action='store_true', help='Show only warnings and errors')
     parser.add_argument('-c', '--city', help='Validate only a single city or a country')
+    parser.add_argument('--cities', help='CSV table of cities to validate, in City row format')
+    parser.add_argument('--workers', type=int, help='Number of processes for validating several cities')
     # parser.add_argument('-t','--overground',action='store_true',help='Process overground transport instead of subway')
     # parser.add_argument('-e','--entrances',type=argparse.FileType('w', encoding='utf-8'),
     # help='Export unused subway entrances as GeoJSON here')
-    parser.add_argument('-l', '--log', type=argparse.FileType('w', encoding='utf-8'), help='Validation JSON file name')
+    parser.add_argument('-l', '--log', type=argparse.FileType('w', encoding='utf-8'), help='Validation NDJSON file name')
+    parser.add_argument('--log-issues', action='store_true', help='Write every warning and error as a line of --log')
     parser.add_argument('-o','--output',type=argparse.FileType('w',encoding='utf-8'),help='Processed bus systems output')
+    parser.add_argument('--max-issues', type=int, help='Keep at most this many warnings or errors of a kind per city')
+    parser.add_argument('--rules', help='Comma-separated checks to run, all by default')
+    parser.add_argument('--skip-rules', help='Comma-separated checks not to run')
+    parser.add_argument('--profile', action='store_true', help='Save cProfile data of every city next to --log')
     parser.add_argument('--cache', help='Cache file name for processed data')
-    parser.add_argument('-r', '--recovery-path', help='Cache file name for error recovery')
-    parser.add_argument('-d', '--dump', help='Make a YAML file for a city data')
+    parser.add_argument('--history', help='SQLite file to add results of this run to')
+    parser.add_argument('-r', '--recovery-path', help='Checkpoint file of finished cities, a failed run resumes from it')
+    parser.add_argument('-d', '--dump', help='Make a binary snapshot file for a city data')
     parser.add_argument('-j', '--geojson', help='Make a GeoJSON file for a city data')
     parser.add_argument('--crude', action='store_true', help='Do not use OSM railway geometry for GeoJSON')
+    parser.add_argument('--simplify', type=float, default=0, help='Simplify GeoJSON lines to this many meters')
+    parser.add_argument('--precision', type=int, default=6, help='Decimal places of GeoJSON coordinates')
+    parser.add_argument('--serve', help='Keep validated cities in memory and answer queries at host:port or a Unix socket path; --source is loaded first')
     options = parser.parse_args()
     
-    options.city = '12601507'  # 范围relation id
+    city_given = bool(options.city)
+    if not options.city:
+        options.city = '12601507'  # 范围relation id
 
     if options.quiet:
         log_level = logging.WARNING
     else:
         log_level = logging.INFO
     logging.basicConfig(level=log_level, datefmt='%H:%M:%S', format='%(asctime)s %(levelname)-7s  %(message)s')
+    rules = None
+    if options.rules or options.skip_rules:
+        rules = select_rules(
+            options.rules.split(',') if options.rules else None,
+            options.skip_rules.split(',') if options.skip_rules else (),
+        )
     
+    # Daemon: snapshots and change files come over HTTP, see service.py
+    if options.serve:
+        store = CityStore(rules, options.max_issues)
+        if options.source:
+            logging.info('Loading %s into city %s', options.source, options.city)
+            store.load(int(options.city), read_json_elements(options.source))
+        server = make_server(options.serve, store)
+        logging.info('Serving at %s', options.serve)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        sys.exit(0)
+
+    # Several cities: --source is a directory of per-city JSON files
+    if options.cities or ',' in options.city:
+        if options.cities:
+            cities = read_city_table(options.cities)
+        else:
+            cities = cities_from_ids(options.city)
+        for city in cities:
+            city.rules = rules
+            if options.max_issues:
+                city.max_issues = options.max_issues
+        log = ValidationLog(options.log, options.log_issues) if options.log else None
+        history = History(options.history) if options.history else None
+        if history:
+            history.start_run(options.cities or options.city)
+
+        def on_result(result, records, routes):
+            if log:
+                log.write(result, records)
+            if history:
+                history.add_city(result, records, routes)
+
+        summaries = validate_cities(
+            cities, options.overpass_api, on_result,
+            options.source, options.workers,
+            profile_log=options.log.name if options.log and options.profile else None,
+            issues=options.log_issues or bool(history),
+            recovery=Recovery(options.recovery_path) if options.recovery_path else None,
+            full=options.full, tile_size=options.tile_size,
+        )
+        if history:
+            history.finish_run()
+            history.close()
+        if options.log:
+            write_metrics(metrics_path(options.log.name), summaries)
+        sys.exit(0)
+
     # Reading cached json, loading XML or querying Overpass API
-    if options.source and os.path.exists(options.source):
+    metrics = Metrics(options.city, profile=options.profile)
+    cache_key = None
+    snapshot = None
+    bbox = None
+    if options.bbox:
+        # The same order as in the city table, City.bbox is (xmin, ymin, xmax, ymax)
+        south, west, north, east = (float(x) for x in options.bbox.split(','))
+        bbox = (west, south, east, north)
+    if options.partition:
+        if not bbox or not options.tile_size:
+            parser.error('--partition needs --bbox and --tile-size')
+        with metrics.profiling():
+            osm = partitioned_elements(
+                options.city, bbox, options.overpass_api, options.tile_size,
+                options.source, options.workers, metrics=metrics, rules=rules,
+            )
+        if options.cache:
+            cache_key = elements_key(osm, {})
+    elif options.snapshot:
+        logging.info('Reading snapshot %s', options.snapshot)
+        snapshot = Snapshot(options.snapshot)
+        if not city_given:
+            # The snapshot knows its city
+            options.city = metrics.name = str(snapshot.city_id)
+        osm = snapshot.elements()
+        if options.cache:
+            cache_key = 'snapshot:{}'.format(file_digest(options.snapshot))
+    elif options.source and os.path.exists(options.source):
         logging.info('Reading data from %s', options.source)
-        with open(options.source, 'r', encoding='utf-8') as f:
-            osm = json.load(f)
-            if 'elements' in osm:
-                osm = osm['elements']
+        osm = read_json_elements(options.source)
+        if options.cache:
+            cache_key = source_key(options.source, read_json_elements)
+    elif options.xml:
+        logging.info('Reading data from %s', options.xml)
+        osm = read_xml_elements(options.xml)
+        if options.cache:
+            cache_key = source_key(options.xml, read_xml_elements)
     else:
         logging.info('Downloading data from Overpass API')
-        osm = overpass_request(options.overpass_api, options.city)
+        header = {}
+        with metrics.span('download'), metrics.profiling():
+            osm = overpass_request(
+                options.overpass_api, options.city, header,
+                full=options.full, bbox=bbox, tile_size=options.tile_size,
+            )
         if options.source:
             with open(options.source, 'w', encoding='utf-8') as f:
                 json.dump(osm, f)
-    logging.info('Downloaded %s elements', len(osm))
+        logging.info('Downloaded %s elements', len(osm))
+        if options.cache:
+            cache_key = elements_key(osm, header)
     
-    validation(options.city, osm)
+    settings = {'rules': rules, 'max_issues': options.max_issues}
+    cached = read_cache(options.cache, options.city, settings) if options.cache else None
+    if cached and cached['key'] == cache_key:
+        logging.info('Snapshot has not changed, using cached results from %s', options.cache)
+        city = cached['city']
+    elif cached:
+        logging.info('Snapshot has changed, revalidating modified routes')
+        cached['city'].rules = rules
+        with metrics.profiling():
+            city = revalidation(cached['city'], osm, metrics)
+    else:
+        city = make_city(options.city, snapshot.city_name if snapshot else '')
+        city.rules = rules
+        if options.max_issues:
+            city.max_issues = options.max_issues
+        if options.source and options.xml and not os.path.exists(options.source):
+            with open(options.source, 'w', encoding='utf-8') as f, metrics.profiling():
+                city = validation(city, write_json_elements(osm, f), metrics)
+        else:
+            with metrics.profiling():
+                city = validation(city, osm, metrics)
+        for rmaster in city.routes.values():
+            print(rmaster)
+    if options.cache and not (cached and cached['key'] == cache_key):
+        write_cache(options.cache, options.city, cache_key, city, settings)
+    if snapshot:
+        snapshot.close()
+    if options.dump:
+        with metrics.span('dump'):
+            write_snapshot(city, options.dump)
 
-    
+    if options.history:
+        history = History(options.history)
+        history.start_run(options.snapshot or options.source or options.xml or options.overpass_api)
+        history.add_city(city.get_validation_result(), list(city.issue_records()), route_rows(city))
+        history.finish_run()
+        history.close()
+
+    if options.log:
+        ValidationLog(options.log, options.log_issues).write_city(city)
+        write_metrics(metrics_path(options.log.name), [metrics.summary()])
+        if options.profile:
+            metrics.dump_profile(profile_path(options.log.name, options.city))
+    else:
+        logging.info('Metrics: %s', json.dumps(metrics.summary()['spans']))
 
+    if options.geojson:
+        with open(options.geojson, 'w', encoding='utf-8') as f:
+            write_geojson(city, f, options.crude, options.simplify, options.precision)
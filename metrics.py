@@ -0,0 +1,113 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+PROFILE_TOP = 30  # functions listed in a summary, by cumulative time
+
+
+class Metrics:
+    # Named spans with wall time and call counts, element counters and an
+    # optional cProfile capture, for one city
+    def __init__(self, name=None, profile=False):
+        self.name = name
+        self.spans = defaultdict(lambda: {'seconds': 0.0, 'calls': 0})
+        self.counts = defaultdict(int)
+        self.profiler = cProfile.Profile() if profile else None
+        self.started = time.time()
+
+    @contextmanager
+    def span(self, name):
+        stats = self.spans[name]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats['seconds'] += time.perf_counter() - start
+            stats['calls'] += 1
+
+    def timed(self, name, iterable):
+        # Passes items through, counting them and the time spent producing
+        # them, e.g. reading and parsing of a streamed source
+        it = iter(iterable)
+        stats = self.spans[name]
+        stats['calls'] += 1
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                stats['seconds'] += time.perf_counter() - start
+                return
+            stats['seconds'] += time.perf_counter() - start
+            self.counts[name] += 1
+            yield item
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    @contextmanager
+    def profiling(self):
+        if self.profiler is None:
+            yield
+            return
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    def dump_profile(self, path):
+        if self.profiler is not None:
+            self.profiler.dump_stats(path)
+
+    def profile_top(self):
+        try:
+            stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        except TypeError:
+            # Nothing was profiled
+            return []
+        stats.sort_stats('cumulative')
+        top = []
+        for func in stats.fcn_list[:PROFILE_TOP]:
+            calls, _, own, cumulative, _ = stats.stats[func]
+            top.append({
+                'function': '{}:{}({})'.format(*func),
+                'calls': calls,
+                'own_seconds': round(own, 4),
+                'cumulative_seconds': round(cumulative, 4),
+            })
+        return top
+
+    def summary(self):
+        result = {
+            'city': self.name,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+            'total_seconds': round(time.time() - self.started, 4),
+            'spans': {
+                name: {'seconds': round(s['seconds'], 4), 'calls': s['calls']}
+                for name, s in self.spans.items()
+            },
+            'counts': dict(self.counts),
+        }
+        if self.profiler is not None:
+            result['profile'] = self.profile_top()
+        return result
+
+
+def metrics_path(log_path):
+    # Metrics of a run are written next to its --log file
+    return os.path.splitext(log_path)[0] + '.metrics.json'
+
+
+def profile_path(log_path, city_id):
+    return '{}.{}.prof'.format(os.path.splitext(log_path)[0], city_id)
+
+
+def write_metrics(path, summaries):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'cities': summaries}, f, ensure_ascii=False, indent=2)
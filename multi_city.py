@@ -0,0 +1,154 @@
+import csv
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+from city import City
+from history import route_rows
+from metrics import Metrics, profile_path
+from osm_reader import read_json_elements, write_json_elements
+from overpass import MAX_CONCURRENT_QUERIES, OverpassClient, city_query
+from validation import make_city, validation
+
+
+def read_city_table(path):
+    # A CSV table in the City row format, the first line is a header. Rows
+    # without modes in column 9 are bus cities, as in make_city().
+    cities = []
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if len(row) > 8 and row[1]:
+                row = row + [''] * (10 - len(row))
+                modes, _, networks = row[9].rpartition(':')
+                if not modes:
+                    row[9] = 'bus:' + networks
+                cities.append(City(row, overground=True))
+    return cities
+
+
+def cities_from_ids(city_ids):
+    return [make_city(city_id.strip()) for city_id in city_ids.split(',') if city_id.strip()]
+
+
+client = None  # OverpassClient of a worker process
+
+
+def init_worker(overpass_api, semaphore):
+    global client
+    client = OverpassClient(overpass_api, semaphore=semaphore)
+
+
+def validate_city(city, source_dir=None, metrics=None, full=False, tile_size=None):
+    # With source_dir, <source_dir>/<city id>.json is read if present and
+    # written while downloading otherwise. With full, route members and
+    # geometry are downloaded; with tile_size, the city bbox is downloaded
+    # in tiles of that many degrees.
+    path = os.path.join(source_dir, '{}.json'.format(city.id)) if source_dir else None
+    if path and os.path.exists(path):
+        return validation(city, read_json_elements(path), metrics)
+    if tile_size and city.bbox:
+        with metrics.span('download'):
+            osm = client.query_tiles(city.bbox, tile_size)
+    else:
+        # Streamed, so download time is counted in the parse span
+        osm = client.query(city_query(city.id, full))
+    if not path:
+        return validation(city, osm, metrics)
+    return validation(city, saved_elements(osm, path), metrics)
+
+
+def saved_elements(elements, path):
+    # Passes elements through while writing them to path. The file gets its
+    # name as soon as the last element is written, so a download is kept
+    # even if validating it fails.
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        yield from write_json_elements(elements, f)
+    os.replace(path + '.tmp', path)
+
+
+def process_city(city, source_dir=None, profile_log=None, issues=False, full=False, tile_size=None):
+    # Runs in a worker process: download, parse and validate one city.
+    # With profile_log, a cProfile dump is written next to that log file.
+    # With issues, structured issue records are returned as well. Route
+    # summaries for the history are always returned, and whether the city
+    # failed to process.
+    metrics = Metrics(city.id, profile=bool(profile_log))
+    failed = False
+    try:
+        with metrics.profiling():
+            city = validate_city(city, source_dir, metrics, full, tile_size)
+    except Exception as e:
+        logging.exception('Failed to process city %s', city.id)
+        city.error('Failed to process city: {}', args=(str(e),))
+        failed = True
+    if profile_log:
+        metrics.dump_profile(profile_path(profile_log, city.id))
+    records = list(city.issue_records()) if issues else None
+    return city.get_validation_result(), records, metrics.summary(), route_rows(city), failed
+
+
+def validate_cities(
+        cities, overpass_api, on_result, source_dir=None, workers=None,
+        max_queries=MAX_CONCURRENT_QUERIES, profile_log=None, issues=False, recovery=None,
+        full=False, tile_size=None,
+):
+    # Cities are independent, so each one goes to its own process.
+    # Downloads are streamed into validation, at most max_queries at a time
+    # across all processes. on_result(result, issue records, route rows) is called as
+    # soon as a city is done, so results are not held. Returns metrics
+    # summaries in the order of cities.
+    # With a Recovery, cities finished by an earlier run are not processed
+    # again, their saved results are passed to on_result instead.
+    if recovery and not source_dir:
+        source_dir = recovery.source_dir
+    if source_dir:
+        os.makedirs(source_dir, exist_ok=True)
+    worker = partial(
+        process_city, source_dir=source_dir, profile_log=profile_log, issues=issues,
+        full=full, tile_size=tile_size,
+    )
+    semaphore = multiprocessing.BoundedSemaphore(max_queries)
+    summaries = [None] * len(cities)
+    failed = 0
+    crashes = 0
+    pending = []
+    for i, city in enumerate(cities):
+        done = recovery.get(city.id) if recovery else None
+        if done is None:
+            pending.append(i)
+            continue
+        summaries[i] = done['summary']
+        if done['result']['errors']:
+            failed += 1
+        on_result(done['result'], done['records'], done['routes'])
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=init_worker, initargs=(overpass_api, semaphore),
+        ) as executor:
+            futures = {executor.submit(worker, cities[i]): i for i in pending}
+            for future in as_completed(futures):
+                i = futures[future]
+                result, records, summaries[i], routes, crashed = future.result()
+                if result['errors']:
+                    failed += 1
+                crashes += crashed
+                on_result(result, records, routes)
+                # A city that failed to process is tried again by the next run
+                if recovery and not crashed:
+                    recovery.add(cities[i].id, result, records, summaries[i], routes)
+    except BaseException:
+        if recovery:
+            recovery.save()
+        raise
+    if recovery and crashes:
+        # Kept, so the next run processes only the cities that failed
+        recovery.save()
+        logging.info('%s cities failed to process, run again to retry them', crashes)
+    elif recovery:
+        recovery.finish()
+    logging.info('Validated %s cities, %s have errors', len(cities), failed)
+    return summaries
@@ -0,0 +1,196 @@
+import json
+import re
+from xml.etree import ElementTree
+
+CHUNK_SIZE = 1 << 16  # characters read from the file at a time
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DECODER = json.JSONDecoder()
+NUMBER_CHARS = '0123456789.eE+-'
+
+
+class JsonStream:
+    # Minimal pull parser over a text file: the structural characters of the
+    # envelope are read by hand, every value inside it is handed to
+    # JSONDecoder.raw_decode, so only one element is kept in memory at a time.
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def take(self, expected):
+        c = self.peek()
+        if c not in expected:
+            raise ValueError('Malformed OSM JSON: expected {!r}, got {!r}'.format(expected, c or 'EOF'))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number ending at the buffer end may be cut in half
+            if (
+                    not isinstance(obj, (dict, list, str))
+                    and (end == len(self.buf) or self.buf[end] in NUMBER_CHARS)
+                    and self.fill()
+            ):
+                continue
+            self.pos = end
+            return obj
+
+    def array(self):
+        self.take('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.take(',]') == ']':
+                return
+
+
+def iter_json_elements(f, header=None, chunk_size=CHUNK_SIZE):
+    # Yields OSM elements one by one from either a bare list of elements or
+    # an Overpass envelope. Other top-level keys of the envelope (version,
+    # generator, osm3s) are stored into `header` if a dict is passed.
+    stream = JsonStream(f, chunk_size)
+    if stream.peek() == '[':
+        yield from stream.array()
+        return
+    stream.take('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.take(':')
+        if key == 'elements':
+            yield from stream.array()
+        else:
+            value = stream.value()
+            if header is not None:
+                header[key] = value
+        if stream.take(',}') == '}':
+            return
+
+
+def read_json_elements(path, header=None):
+    with open(path, 'r', encoding='utf-8') as f:
+        yield from iter_json_elements(f, header)
+
+
+def xml_element(xml_el):
+    # An OSM element from its XML in the shape of Overpass JSON output
+    tag = xml_el.tag
+    el = {'type': tag, 'id': int(xml_el.get('id'))}
+    if xml_el.get('version'):
+        el['version'] = int(xml_el.get('version'))
+    if tag == 'node' and xml_el.get('lat'):
+        el['lat'] = float(xml_el.get('lat'))
+        el['lon'] = float(xml_el.get('lon'))
+    tags = {}
+    nodes = []
+    members = []
+    for sub in xml_el:
+        if sub.tag == 'tag':
+            tags[sub.get('k')] = sub.get('v')
+        elif sub.tag == 'nd':
+            nodes.append(int(sub.get('ref')))
+        elif sub.tag == 'member':
+            members.append({
+                'type': sub.get('type'),
+                'ref': int(sub.get('ref')),
+                'role': sub.get('role', ''),
+            })
+    if tag == 'way':
+        el['nodes'] = nodes
+    elif tag == 'relation':
+        el['members'] = members
+    if tags:
+        el['tags'] = tags
+    return el
+
+
+def iter_xml_elements(f, header=None):
+    # Yields OSM elements from an .osm XML extract in the same shape as
+    # Overpass JSON output. Processed elements are cleared and detached from
+    # the root, so memory stays bounded on large extracts.
+    context = ElementTree.iterparse(f, events=('start', 'end'))
+    _, root = next(context)
+    if header is not None:
+        header['version'] = root.get('version')
+        header['generator'] = root.get('generator')
+    for event, xml_el in context:
+        if event != 'end':
+            continue
+        tag = xml_el.tag
+        if tag in ('node', 'way', 'relation'):
+            yield xml_element(xml_el)
+            root.clear()
+        elif tag == 'meta' and header is not None:
+            # Overpass XML output keeps the snapshot timestamp here
+            header['osm3s'] = {'timestamp_osm_base': xml_el.get('osm_base')}
+
+
+def read_xml_elements(path, header=None):
+    with open(path, 'rb') as f:
+        yield from iter_xml_elements(f, header)
+
+
+def iter_osm_change(f):
+    # Yields (action, element) from an osmChange file, action is 'create',
+    # 'modify' or 'delete'
+    context = ElementTree.iterparse(f, events=('start', 'end'))
+    _, root = next(context)
+    action = None
+    for event, xml_el in context:
+        tag = xml_el.tag
+        if tag in ('create', 'modify', 'delete'):
+            action = tag if event == 'start' else None
+            if event == 'end':
+                root.clear()
+        elif event == 'end' and tag in ('node', 'way', 'relation') and action:
+            yield action, xml_element(xml_el)
+            xml_el.clear()
+
+
+def write_json_elements(elements, f):
+    # Passes elements through while writing them to f as a JSON list,
+    # which iter_json_elements can read back
+    f.write('[')
+    try:
+        first = True
+        for el in elements:
+            if not first:
+                f.write(',\n')
+            json.dump(el, f, ensure_ascii=False)
+            first = False
+            yield el
+    finally:
+        f.write(']\n')
@@ -0,0 +1,214 @@
+import gzip
+import http.client
+import io
+import logging
+import math
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from osm_reader import iter_json_elements
+
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_CONCURRENT_QUERIES = 2  # Overpass API gives two slots per client by default
+SPOOL_SIZE = 64 * 1024 * 1024  # bytes of a response kept in memory, larger ones go to a temporary file
+RELATION_FILTERS = (
+    '[type=route][route=bus]',
+    '[type=route_master][route_master=bus]',
+    '[public_transport=stop_area]',
+    '[public_transport=stop_area_group]',
+)
+
+
+def full_query(area_filter, prefix=''):
+    # Route, route_master and stop area relations with their member nodes and
+    # ways in one response. "out geom" puts coordinates on ways and on members
+    # of relations, so nothing else has to be fetched.
+    query = '[out:json][timeout:1000];' + prefix + '('
+    query += ''.join('rel{}{};'.format(f, area_filter) for f in RELATION_FILTERS)
+    query += ')->.rels;(.rels;rel(br.rels)[type=route_master];node(r.rels);way(r.rels););out body geom qt;'
+    return query
+
+
+def city_query(city_relation_id, full=False):
+    if full:
+        return full_query('(area.city)', 'relation({});map_to_area->.city;.city out tags;'.format(city_relation_id))
+    query = '[out:json][timeout:1000];(relation({});map_to_area;'.format(city_relation_id)
+    query += 'rel[type=route][route=bus](area););out tags qt;'
+    return query
+
+
+def split_bbox(bbox, tile_size):
+    # bbox is (xmin, ymin, xmax, ymax) like City.bbox, tiles are at most
+    # tile_size degrees wide and high
+    xmin, ymin, xmax, ymax = bbox
+    nx = max(1, math.ceil((xmax - xmin) / tile_size))
+    ny = max(1, math.ceil((ymax - ymin) / tile_size))
+    dx = (xmax - xmin) / nx
+    dy = (ymax - ymin) / ny
+    return [
+        (xmin + i * dx, ymin + j * dy, xmin + (i + 1) * dx, ymin + (j + 1) * dy)
+        for j in range(ny) for i in range(nx)
+    ]
+
+
+def bbox_query(bbox):
+    # Overpass wants (south, west, north, east)
+    xmin, ymin, xmax, ymax = bbox
+    return full_query('({},{},{},{})'.format(ymin, xmin, ymax, xmax))
+
+
+class HttpTransport:
+    # Keeps one keep-alive connection per thread
+    def __init__(self, url, timeout=1000):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            conn = self.connection_class(self.host, self.port, timeout=self.timeout)
+            self.local.connection = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self.local.connection = None
+
+    def request(self, query):
+        body = urllib.parse.urlencode({'data': query})
+        headers = {
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+        try:
+            conn = self.connection()
+            conn.request('POST', self.path, body, headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            # The server may have dropped an idle connection, try a fresh one once
+            self.close()
+            conn = self.connection()
+            conn.request('POST', self.path, body, headers)
+            response = conn.getresponse()
+        if response.getheader('Connection', '').lower() == 'close':
+            self.local.connection = None
+        return response.status, {k.lower(): v for k, v in response.getheaders()}, response
+
+
+class FileTransport:
+    # Answers every query with a saved Overpass response, for offline runs and tests
+    def __init__(self, path):
+        self.path = path
+
+    def request(self, query):
+        return 200, {}, open(self.path, 'rb')
+
+
+def make_transport(overpass_api):
+    if overpass_api.startswith('file://'):
+        return FileTransport(overpass_api[len('file://'):])
+    return HttpTransport(overpass_api)
+
+
+class OverpassClient:
+    def __init__(
+            self, overpass_api=None, transport=None, max_concurrent=MAX_CONCURRENT_QUERIES,
+            retries=5, backoff=5.0, semaphore=None,
+    ):
+        self.transport = transport or make_transport(overpass_api)
+        self.max_concurrent = max_concurrent
+        # A multiprocessing semaphore may be passed to share the limit between processes
+        self.semaphore = semaphore or threading.BoundedSemaphore(max_concurrent)
+        self.retries = retries
+        self.backoff = backoff
+
+    def send(self, query):
+        for attempt in range(self.retries + 1):
+            try:
+                status, headers, body = self.transport.request(query)
+            except (http.client.HTTPException, OSError) as e:
+                if attempt == self.retries:
+                    raise
+                status, headers, reason = None, {}, str(e)
+            else:
+                if status == 200:
+                    return headers, body
+                body.read()
+                body.close()
+                reason = 'HTTP {}'.format(status)
+                if status not in RETRY_STATUSES or attempt == self.retries:
+                    raise Exception('Failed to query Overpass API: {}'.format(reason))
+            delay = self.backoff * 2 ** attempt
+            if headers.get('retry-after', '').isdigit():
+                delay = max(delay, int(headers['retry-after']))
+            logging.warning('Overpass API: %s, retrying in %s s', reason, delay)
+            time.sleep(delay)
+
+    def query(self, query, header=None):
+        # Yields elements of the response. The response is buffered before
+        # parsing, so the Overpass slot is free again while the caller builds
+        # a city from the elements.
+        logging.debug('Query: %s', query)
+        buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        with self.semaphore:
+            headers, body = self.send(query)
+            with body:
+                shutil.copyfileobj(body, buffer)
+        buffer.seek(0)
+        with buffer:
+            body = buffer
+            if headers.get('content-encoding') == 'gzip':
+                body = gzip.GzipFile(fileobj=body, mode='rb')
+            text = io.TextIOWrapper(body, encoding='utf-8')
+            yield from iter_json_elements(text, header)
+        if header is not None and 'remark' in header:
+            logging.warning('Overpass API: %s', header['remark'])
+
+    def query_all(self, queries, headers=None):
+        # Runs queries concurrently, returns a list of elements for each one.
+        # headers, if given, is a list of dicts to fill, one per query.
+        headers = headers or [None] * len(queries)
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            return list(executor.map(lambda q, h: list(self.query(q, h)), queries, headers))
+
+    def query_tiles(self, bbox, tile_size, header=None):
+        # Fetches a bbox tile by tile; relations crossing tiles and their
+        # members come in several responses, but are returned once
+        tiles = split_bbox(bbox, tile_size)
+        headers = [{} for _ in tiles]
+        seen = set()
+        elements = []
+        for tile_elements in self.query_all([bbox_query(t) for t in tiles], headers):
+            for el in tile_elements:
+                key = (el['type'], el['id'])
+                if key not in seen:
+                    seen.add(key)
+                    elements.append(el)
+        if header is not None:
+            # The oldest tile decides how fresh the whole result is
+            header.update(min(headers, key=lambda h: h.get('osm3s', {}).get('timestamp_osm_base', '')))
+        logging.info('Fetched %s tiles, %s elements', len(tiles), len(elements))
+        return elements
+
+
+def overpass_request(overpass_api, city_relation_id, header=None, client=None, full=False, bbox=None, tile_size=None):
+    # With bbox and tile_size the bbox is fetched in tiles, always with members
+    client = client or OverpassClient(overpass_api)
+    if bbox and tile_size:
+        return client.query_tiles(bbox, tile_size, header)
+    return list(client.query(city_query(city_relation_id, full), header))
@@ -0,0 +1,150 @@
+import logging
+import math
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import multi_city
+from chain import member_coords
+from metrics import Metrics
+from multi_city import init_worker, saved_elements
+from osm_reader import read_json_elements
+from overpass import MAX_CONCURRENT_QUERIES, bbox_query, split_bbox
+from route import Route
+from rules import select_rules
+from validation import chain_routes, is_city_route, make_city
+
+# Partitioned validation of a large bbox. A tile response has every member
+# of the relations it returns, so a worker process validates the lines of
+# routes owned by its tile and sends back only compact records: nodes,
+# relations without member geometry, and routes reduced to their stops and
+# the issues of their line. Way geometry never leaves the workers, so a
+# worker holds one tile and the reduce step only the stops and relations.
+# An element is owned by the tile its first coordinate falls into; elements
+# without coordinates come from every tile and are deduplicated.
+
+
+def owned_areas(tiles):
+    # Tiles are half-open, so a point on a border belongs to one tile only.
+    # Tiles on the edge of the bbox also own what lies beyond it, where
+    # members of routes crossing the border are.
+    xmin = min(t[0] for t in tiles)
+    ymin = min(t[1] for t in tiles)
+    xmax = max(t[2] for t in tiles)
+    ymax = max(t[3] for t in tiles)
+    return [(
+        -math.inf if t[0] == xmin else t[0],
+        -math.inf if t[1] == ymin else t[1],
+        math.inf if t[2] == xmax else t[2],
+        math.inf if t[3] == ymax else t[3],
+    ) for t in tiles]
+
+
+def in_area(area, coords):
+    lon, lat = coords[0]
+    xmin, ymin, xmax, ymax = area
+    return xmin <= lon < xmax and ymin <= lat < ymax
+
+
+def first_coords(elements, relation):
+    for m in relation['members']:
+        coords = member_coords(elements, m)
+        if coords:
+            return coords
+    return None
+
+
+def tile_elements(tile_index, tile, city_id, source_dir=None):
+    path = os.path.join(source_dir, '{}-tile-{}.json'.format(city_id, tile_index)) if source_dir else None
+    if path and os.path.exists(path):
+        return read_json_elements(path)
+    elements = multi_city.client.query(bbox_query(tile))
+    if not path:
+        return elements
+    return saved_elements(elements, path)
+
+
+def map_tile(tile_index, tile, area, city_id, source_dir=None, rules=None):
+    # Runs in a worker process: reads a tile into a city of its own, builds
+    # the lines of owned routes there and returns what the reduce step needs
+    city = make_city(city_id)
+    city.max_issues = sys.maxsize  # The city the tiles are reduced to applies the limit
+    # Route tags are checked by the reduced city, it has them
+    city.rules = [name for name in select_rules(rules) if name != 'route_tags']
+    for el in tile_elements(tile_index, tile, city_id, source_dir):
+        if el['type'] != 'area':
+            city.add(el)
+    nodes = []
+    relations = []
+    route_ids = []
+    for el in city.elements.values():
+        if el['type'] == 'node':
+            if 'lat' in el and in_area(area, [(el['lon'], el['lat'])]):
+                nodes.append({k: el[k] for k in ('type', 'id', 'lat', 'lon', 'tags') if k in el})
+            continue
+        if el['type'] != 'relation' or 'tags' not in el:
+            continue
+        coords = first_coords(city.elements, el)
+        if coords and not in_area(area, coords):
+            continue
+        if is_city_route(city, el):
+            city.route_by_id[el['id']] = Route(el['id'], el['tags'], city)
+            route_ids.append(el['id'])
+        else:
+            relations.append({
+                'type': 'relation',
+                'id': el['id'],
+                'tags': el['tags'],
+                'members': [{'type': m['type'], 'ref': m['ref'], 'role': m['role']} for m in el['members']],
+            })
+    chain_routes(city, route_ids, Metrics())
+    for route_id in route_ids:
+        bucket = city.element_issues.get(route_id)
+        issues = [(True, i) for i in bucket.errors] + [(False, i) for i in bucket.warnings] if bucket else []
+        relations.append({
+            'type': 'relation',
+            'id': route_id,
+            'tags': city.elements['r{}'.format(route_id)]['tags'],
+            'members': [{'type': 'node', 'ref': n, 'role': 'stop'} for n in city.route_by_id[route_id].stops],
+            # See add_route()
+            'line_issues': [(is_error, i.code, i.message, i.args) for is_error, i in issues],
+        })
+    return {'nodes': nodes, 'relations': relations}
+
+
+def reduce_tiles(partials):
+    # The reduce step: records are merged as workers return them
+    nodes = {}
+    relations = {}
+    for p in partials:
+        for el in p['nodes']:
+            nodes[el['id']] = el
+        for el in p['relations']:
+            relations.setdefault(el['id'], el)
+    return list(nodes.values()) + list(relations.values())
+
+
+def partitioned_elements(
+        city_id, bbox, overpass_api, tile_size, source_dir=None, workers=None,
+        max_queries=MAX_CONCURRENT_QUERIES, metrics=None, rules=None,
+):
+    # Returns reduced elements of bbox, mapped tile by tile in worker
+    # processes. With source_dir, tiles are read from and saved to
+    # <source_dir>/<city id>-tile-<n>.json. rules are the names of the
+    # checks to run, as City.rules.
+    metrics = metrics or Metrics(city_id)
+    if source_dir:
+        os.makedirs(source_dir, exist_ok=True)
+    tiles = split_bbox(bbox, tile_size)
+    logging.info('Validating %s tiles', len(tiles))
+    semaphore = multiprocessing.BoundedSemaphore(max_queries)
+    worker = partial(map_tile, city_id=city_id, source_dir=source_dir, rules=rules)
+    with metrics.span('tiles'), ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker, initargs=(overpass_api, semaphore),
+    ) as executor:
+        elements = reduce_tiles(executor.map(worker, range(len(tiles)), tiles, owned_areas(tiles)))
+    metrics.count('tiles', len(tiles))
+    return elements
+
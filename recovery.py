@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+import shutil
+import time
+
+RECOVERY_VERSION = 2  # Bump when the format of saved results changes
+CHECKPOINT_INTERVAL = 30  # seconds between checkpoints
+
+
+class Recovery:
+    # Results of finished cities of a multi-city run. They are saved to path
+    # at most every interval seconds and when the run fails, so a restarted
+    # run skips them. Downloads of unfinished cities are kept in source_dir.
+    def __init__(self, path, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.source_dir = path + '.sources'
+        self.interval = interval
+        self.cities = self.load()
+        self.saved = time.monotonic()
+        self.dirty = False
+        if self.cities:
+            logging.info('Resuming from %s, %s cities are done', path, len(self.cities))
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning('Cannot read recovery file %s: %s', self.path, e)
+            return {}
+        if data.get('version') != RECOVERY_VERSION:
+            logging.info('Ignoring recovery file %s made by another version', self.path)
+            return {}
+        return data['cities']
+
+    def get(self, city_id):
+        # Returns {'result', 'records', 'summary', 'routes'} of a finished city, or None
+        return self.cities.get(str(city_id))
+
+    def add(self, city_id, result, records, summary, routes):
+        self.cities[str(city_id)] = {'result': result, 'records': records, 'summary': summary, 'routes': routes}
+        self.dirty = True
+        if time.monotonic() - self.saved >= self.interval:
+            self.save()
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': RECOVERY_VERSION, 'cities': self.cities}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.saved = time.monotonic()
+        self.dirty = False
+
+    def finish(self):
+        # The run is complete, nothing is left to recover
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        shutil.rmtree(self.source_dir, ignore_errors=True)
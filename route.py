@@ -1,3 +1,5 @@
+import sys
+from array import array
 
 CONSTRUCTION_KEYS = (
     'construction',
@@ -6,40 +8,50 @@ CONSTRUCTION_KEYS = (
     'proposed:railway',
 )
 
+def intern(value):
+    # Operators, networks and terminals repeat across many routes
+    return sys.intern(value) if value is not None else None
+
+
 class Route:
+    __slots__ = (
+        'city', 'route_id', 'type', 'route', 'name', 'ref', 'network', 'operator', 'version',
+        'route_from', 'route_to', 'official_name', 'roundtrip', 'via', 'fee', 'charge', 'stops',
+    )
+
     def __init__(self, route_id, relation, city):
         
+        # The tag dict is not kept, only the values we use
         self.city = city
-        self.element = relation
         self.route_id = route_id
         
-        self.type = relation['type']
-        self.route = relation['route']
-        self.name = relation['name']
-        self.ref = relation.get('ref', None)
-        self.operator = relation.get('operator', None)
-        self.version = relation.get('public_transport:version', None)
-        self.route_from = relation.get('from', None)
-        self.route_to = relation.get('to', None)
+        self.type = intern(relation['type'])
+        self.route = intern(relation['route'])
+        self.name = relation.get('name')
+        self.ref = intern(relation.get('ref', None))
+        self.network = intern(relation.get('network', None))
+        self.operator = intern(relation.get('operator', None))
+        self.version = intern(relation.get('public_transport:version', None))
+        self.route_from = intern(relation.get('from', None))
+        self.route_to = intern(relation.get('to', None))
         
         self.official_name = ''
         self.roundtrip = ''
         self.via = ''
         self.fee = ''
         self.charge = ''
-        self.stops = []
-        
-        if self.version is None:
-            city.warn('Public transport version is 1, which means the route is an unsorted pile of objects', relation)
-        
-        if self.ref is None:
-            city.warn('Missing ref on a route', relation)
-
-        if self.route_from is None:
-            city.warn('Missing "from" on a route', relation)
+        self.stops = array('q')  # Node ids of stops in order
+        # Tags are checked by the route_tags rule
 
-        if self.route_to is None:
-            city.warn('Missing "to" on a route', relation)
+    @property
+    def element(self):
+        # Enough of the relation for City.log_message
+        tags = {}
+        if self.name is not None:
+            tags['name'] = self.name
+        if self.ref is not None:
+            tags['ref'] = self.ref
+        return {'type': 'relation', 'id': self.route_id, 'tags': tags}
 
     def __len__(self):
         return len(self.stops)
@@ -63,12 +75,17 @@ class Route:
             self.route_to,
         )
         
+    @staticmethod
+    def get_network(el):
+        if not el:
+            return None
+        return el.get('tags', {}).get('network')
+
     @staticmethod
     def is_route(el, modes):
+        # Members are not required, "out tags" output has none
         if el['type'] != 'relation' or el.get('tags', {}).get('type') != 'route':
             return False
-        if 'members' not in el:
-            return False
         if el['tags'].get('route') not in modes:
             return False
         for k in CONSTRUCTION_KEYS:
@@ -79,6 +96,8 @@ class Route:
         return True
 
 class RouteMaster:
+    __slots__ = ('relation', 'city', 'ref', 'name', 'official_name', 'routes')
+
     def __init__(self, ref, relation, city):
         self.relation = relation
         self.city = city
@@ -88,10 +107,169 @@ class RouteMaster:
         self.official_name = ''
         self.routes = []
 
+    def __len__(self):
+        return len(self.routes)
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def add(self, route, city):
+        self.routes.append(route)
+
+    @property
+    def id(self):
+        # El_id of the route_master relation, or the ref of a group without one
+        return 'r{}'.format(self.relation['id']) if self.relation else self.ref
+
+    @property
+    def network(self):
+        if self.relation:
+            return Route.get_network(self.relation)
+        return self.routes[0].network if self.routes else None
+
+    @property
+    def mode(self):
+        return self.routes[0].route if self.routes else None
+
+    @property
+    def best(self):
+        return self.routes[0] if self.routes else None
+
+    def stop_areas(self):
+        # Stop areas of all stops in all variants, each once
+        seen = set()
+        for route in self.routes:
+            for stop in route.stops:
+                for sa in self.city.stations.get('n{}'.format(stop), ()):
+                    if sa.id not in seen:
+                        seen.add(sa.id)
+                        yield sa
+
     def __repr__(self):
         text = 'RouteMaster(ref={}, count={})'.format(self.ref, len(self.routes))
         for r in self.routes:
             text = text + '\n\t' + str(r)
             
         return text
-    
\ No newline at end of file
+    
+
+class RouteGroups:
+    # Groups routes of a city into City.routes by (route_master id, network,
+    # ref). Route directions are matched through an index of
+    # (first stop, last stop) endpoints over all routes of the city.
+    def __init__(self, city):
+        self.city = city
+        self.group_of = {}  # Route id → key of its RouteMaster in City.routes
+        self.master_routes = {}  # Route_master id → ids of routes grouped under it
+
+    def key(self, route):
+        master = self.city.masters.get('r{}'.format(route.route_id))
+        if master is not None:
+            return master['id'], route.network, route.ref
+        if route.ref is None:
+            # Without a ref or a route_master nothing ties a route to others;
+            # a negative id cannot clash with a relation id
+            return -route.route_id, route.network, None
+        return None, route.network, route.ref
+
+    def add(self, route):
+        k = self.key(route)
+        rmaster = self.city.routes.get(k)
+        if rmaster is None:
+            master = self.city.masters.get('r{}'.format(route.route_id))
+            rmaster = self.city.routes[k] = RouteMaster(route.ref, master, self.city)
+        rmaster.add(route, self.city)
+        self.group_of[route.route_id] = k
+        if k[0] is not None and k[0] > 0:
+            self.master_routes.setdefault(k[0], set()).add(route.route_id)
+        return rmaster
+
+    def remove(self, route):
+        k = self.group_of.pop(route.route_id)
+        rmaster = self.city.routes[k]
+        rmaster.routes.remove(route)
+        if not rmaster.routes:
+            del self.city.routes[k]
+        if k[0] is not None and k[0] > 0:
+            self.master_routes[k[0]].discard(route.route_id)
+            if not self.master_routes[k[0]]:
+                del self.master_routes[k[0]]
+
+    def update_master(self, master):
+        # A route_master may come after its routes, or change or go away
+        # later: moves its members and the routes grouped under it before
+        # to the groups they belong to now
+        route_ids = {m['ref'] for m in master.get('members', ()) if m['type'] == 'relation'}
+        route_ids.update(self.master_routes.get(master['id'], ()))
+        for route_id in route_ids:
+            route = self.city.route_by_id.get(route_id)
+            if route is not None and self.group_of.get(route_id) != self.key(route):
+                self.remove(route)
+                self.add(route)
+        # Groups that stay under the master get its current tags
+        relation = self.city.elements.get('r{}'.format(master['id']))
+        for route_id in self.master_routes.get(master['id'], ()):
+            self.city.routes[self.group_of[route_id]].relation = relation
+
+    def endpoint(self, stop):
+        # A stop as its stop area, or the stop_area_group of that stop area,
+        # because a vehicle may arrive at different stop areas of a transfer
+        stop_areas = self.city.stop_areas.get('n{}'.format(stop))
+        if not stop_areas:
+            return 'n{}'.format(stop), None
+        sa = 'r{}'.format(stop_areas[0]['id'])
+        interchanges = self.city.interchanges
+        return sa, interchanges.find(sa) if sa in interchanges else None
+
+    def endpoints(self, route):
+        (first, first_tr), (last, last_tr) = self.endpoint(route.stops[0]), self.endpoint(route.stops[-1])
+        # A transfer at both ends would make the route look circular
+        if first_tr is None or last_tr is None or first_tr == last_tr:
+            return first, last
+        return first_tr, last_tr
+
+    def endpoint_index(self):
+        # (group key, endpoints) → first route with them
+        index = {}
+        for k, rmaster in self.city.routes.items():
+            for route in rmaster:
+                if len(route) >= 2:
+                    index.setdefault((k, self.endpoints(route)), route)
+        return index
+
+    def check_return_routes(self, index=None):
+        if index is None:
+            index = self.endpoint_index()
+        variants = {}  # Group key → number of distinct endpoints
+        for (k, t), route in index.items():
+            variants[k] = variants.get(k, 0) + 1
+        for k, rmaster in self.city.routes.items():
+            count = variants.get(k, 0)
+            if count == 0:
+                # Routes read without members ("out tags") cannot be checked
+                if not any('r{}'.format(route.route_id) in self.city.elements for route in rmaster):
+                    continue
+                self.city.error(
+                    'An empty route master {}. Please set construction:route '
+                    'if it is under construction',
+                    args=(rmaster.id,),
+                )
+                continue
+            for route in rmaster:
+                if len(route) < 2:
+                    continue
+                t = self.endpoints(route)
+                first = index[(k, t)]
+                if first is not route:
+                    if first.stops == route.stops:
+                        self.city.warn('Route is a duplicate of {}', route.element, args=('r{}'.format(first.route_id),))
+                    continue
+                if count == 1:
+                    self.city.error_if(
+                        t[0] != t[1],
+                        'Only one route in route_master. '
+                        'Please check if it needs a return route',
+                        route.element,
+                    )
+                elif (k, (t[1], t[0])) not in index:
+                    self.city.warn('Route does not have a return direction', route.element)
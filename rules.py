@@ -0,0 +1,472 @@
+from collections import Counter, defaultdict
+
+from city import (
+    ALLOWED_STATIONS_MISMATCH,
+    ALLOWED_TRANSFERS_MISMATCH,
+    DISPLACEMENT_TOLERANCE,
+    MAX_DISTANCE_TO_ENTRANCES,
+    el_id,
+    element_kinds,
+    format_elid_list,
+)
+from geometry import check_route_geometry
+from transfers import UnionFind, is_stop_area
+
+RULES = {}  # Rule name → Rule subclass, in the order they report
+
+
+def rule(cls):
+    RULES[cls.name] = cls
+    return cls
+
+
+class Rule:
+    # A city check. run_rules() feeds it the elements of its kinds (see
+    # element_kinds), every RouteMaster if masters is set and every Route if
+    # routes is set, then calls finish(). State for a run lives on the
+    # instance. A building rule checks single routes instead: chain_routes()
+    # calls built() for every route it builds, so its issues are kept and
+    # dropped with the route.
+    name = None
+    kinds = ()
+    masters = False
+    routes = False
+    building = False
+    overground = None  # True or False to run only for such cities
+
+    def __init__(self, city):
+        self.city = city
+
+    def element(self, el, kind):
+        pass
+
+    def master(self, rmaster):
+        pass
+
+    def route(self, route):
+        pass
+
+    def built(self, route, chain):
+        # chain is the Chain of the route's ways, None for a route read
+        # without members
+        pass
+
+    def finish(self):
+        pass
+
+
+@rule
+class RouteTags(Rule):
+    name = 'route_tags'
+    building = True
+
+    def built(self, route, chain):
+        city = self.city
+        if route.version is None:
+            city.warn('Public transport version is 1, which means the route is an unsorted pile of objects', route.element)
+        if route.ref is None:
+            city.warn('Missing ref on a route', route.element)
+        if route.route_from is None:
+            city.warn('Missing "from" on a route', route.element)
+        if route.route_to is None:
+            city.warn('Missing "to" on a route', route.element)
+
+
+@rule
+class RouteLine(Rule):
+    # The ways of a route should make one continuous line that passes the
+    # stops in order
+    name = 'route_line'
+    building = True
+
+    def built(self, route, chain):
+        if chain is None:
+            return
+        city = self.city
+        for way_id in chain.gaps:
+            city.error('Route line has a gap after way {}', route.element, args=(way_id,))
+        for way_id in chain.misordered:
+            city.warn('Way {} is out of order in the route', route.element, args=(way_id,))
+        for node in chain.forks:
+            city.warn('Route line forks at {}', route.element, args=(node if isinstance(node, tuple) else 'n{}'.format(node),))
+        if not chain.by_id:
+            # Without node ids the order is checked on geometry
+            return
+        positions = {}
+        for i, node in enumerate(chain.nodes):
+            positions.setdefault(node, i)
+        last = -1
+        stops = route.stops
+        for i, stop in enumerate(stops):
+            if i == len(stops) - 1 and stop == stops[0]:
+                # A circular route comes back to its first stop
+                break
+            pos = positions.get(stop)
+            if pos is None:
+                continue
+            if pos < last:
+                city.warn('Stops are not in order along the route line', route.element)
+                break
+            last = pos
+
+
+@rule
+class RouteGeometry(Rule):
+    # Stops should be close to the route line, without sharp turns between them
+    name = 'route_geometry'
+    building = True
+
+    def built(self, route, chain):
+        line = [c for c in chain.coords if c] if chain else None
+        if line:
+            check_route_geometry(self.city, route, line, check_order=not chain.by_id)
+
+
+@rule
+class RouteMasters(Rule):
+    name = 'route_masters'
+    kinds = ('route_master',)
+
+    def __init__(self, city):
+        super().__init__(city)
+        self.master_of = {}  # Route el_id → id of the first route_master it is in
+
+    def element(self, el, kind):
+        for m in el['members']:
+            if m['type'] == 'relation' and self.master_of.setdefault(el_id(m), el['id']) != el['id']:
+                self.city.error('Route in two route_masters', m)
+
+
+@rule
+class StopAreas(Rule):
+    name = 'stop_areas'
+    kinds = ('stop_area',)
+
+    def element(self, el, kind):
+        members = [el_id(m) for m in el['members']]
+        if len(set(members)) < len(members):
+            self.city.warn('Duplicate element in a stop area', el)
+
+
+@rule
+class Interchanges(Rule):
+    # Stop areas of a stop_area_group make an interchange, see find_transfers()
+    name = 'interchanges'
+    kinds = ('stop_area_group',)
+
+    def __init__(self, city):
+        super().__init__(city)
+        self.group_of = {}  # Stop area el_id → el_id of the first group it is in
+
+    def element(self, el, kind):
+        city = self.city
+        for m in el['members']:
+            k = el_id(m)
+            member = city.elements.get(k)
+            if not member:
+                # A member may validly not belong to the city while the
+                # group does, near the city bbox boundary
+                continue
+            if 'tags' not in member:
+                city.error('An untagged object {} in a stop_area_group', el, args=(k,))
+            elif is_stop_area(member) and self.group_of.setdefault(k, el_id(el)) != el_id(el):
+                city.error('Stop area {} belongs to multiple interchanges', args=(k,))
+
+
+@rule
+class ReturnRoutes(Rule):
+    name = 'return_routes'
+    routes = True
+
+    def __init__(self, city):
+        super().__init__(city)
+        self.index = {}
+
+    def route(self, route):
+        if len(route) >= 2:
+            groups = self.city.groups
+            key = groups.group_of[route.route_id], groups.endpoints(route)
+            self.index.setdefault(key, route)
+
+    def finish(self):
+        self.city.groups.check_return_routes(self.index)
+
+
+@rule
+class Stations(Rule):
+    name = 'stations'
+    masters = True
+
+    def __init__(self, city):
+        super().__init__(city)
+        self.found = 0
+        self.unused = set(city.station_ids)
+
+    def master(self, rmaster):
+        route_stations = set()
+        for sa in rmaster.stop_areas():
+            route_stations.add(sa.transfer or sa.id)
+            self.unused.discard(sa.station.id)
+        self.found += len(route_stations)
+
+    def finish(self):
+        city = self.city
+        city.found_stations = self.found
+        city.found_interchanges = len(city.transfers)
+        if self.unused:
+            city.unused_stations = len(self.unused)
+            city.warn(
+                '{} unused stations: {}',
+                args=(city.unused_stations, format_elid_list(self.unused)),
+            )
+        if city.overground:
+            return
+        if city.found_stations != city.num_stations:
+            city.error_if(
+                not (
+                        0
+                        <= (city.num_stations - city.found_stations)
+                        / city.num_stations
+                        <= ALLOWED_STATIONS_MISMATCH
+                ),
+                'Found {} stations in routes, expected {}',
+                args=(city.found_stations, city.num_stations),
+            )
+        if city.found_interchanges != city.num_interchanges:
+            city.error_if(
+                city.num_interchanges != 0
+                and not (
+                        (city.num_interchanges - city.found_interchanges)
+                        / city.num_interchanges
+                        <= ALLOWED_TRANSFERS_MISMATCH
+                ),
+                'Found {} interchanges, expected {}',
+                args=(city.found_interchanges, city.num_interchanges),
+            )
+
+
+@rule
+class UnusedEntrances(Rule):
+    name = 'unused_entrances'
+    kinds = ('stop_area', 'subway_entrance')
+
+    def __init__(self, city):
+        super().__init__(city)
+        self.in_stop_areas = set()
+        self.entrances = []
+
+    def element(self, el, kind):
+        if kind == 'stop_area':
+            self.in_stop_areas.update(el_id(m) for m in el['members'])
+        else:
+            self.entrances.append(el)
+
+    def finish(self):
+        city = self.city
+        unused = []
+        not_in_sa = []
+        far = []
+        stations = city.spatial_index('station') if self.entrances else None
+        for el in self.entrances:
+            i = el_id(el)
+            if i in self.in_stop_areas:
+                continue
+            not_in_sa.append(i)
+            if i not in city.stations:
+                unused.append(i)
+                if 'lat' in el and not stations.nearest(el['lon'], el['lat'], MAX_DISTANCE_TO_ENTRANCES):
+                    far.append(i)
+        city.unused_entrances = len(unused)
+        city.entrances_not_in_stop_areas = len(not_in_sa)
+        if unused:
+            city.warn(
+                'Found {} entrances not used in routes or stop_areas: {}',
+                args=(len(unused), format_elid_list(unused)),
+            )
+        if not_in_sa:
+            city.warn(
+                '{} subway entrances are not in stop_area relations: {}',
+                args=(len(not_in_sa), format_elid_list(not_in_sa)),
+            )
+        if far:
+            city.warn(
+                '{} unused entrances are farther than {} meters from any station: {}',
+                args=(len(far), MAX_DISTANCE_TO_ENTRANCES, format_elid_list(far)),
+            )
+
+
+@rule
+class StopTags(Rule):
+    # Route stops should be tagged as stop positions, platforms or bus stops.
+    # A stop tagged so nearby is likely the one the route should use.
+    name = 'stop_tags'
+    routes = True
+
+    def __init__(self, city):
+        super().__init__(city)
+        self.untagged = []  # (route, node) of route stops without stop tags
+
+    def route(self, route):
+        for node_id in route.stops:
+            el = self.city.elements.get('n{}'.format(node_id))
+            if el and 'lat' in el and 'stop' not in element_kinds(el):
+                self.untagged.append((route, el))
+
+    def finish(self):
+        city = self.city
+        stops = city.spatial_index('stop') if self.untagged else None
+        for route, el in self.untagged:
+            near = stops.within(el['lon'], el['lat'], DISPLACEMENT_TOLERANCE)
+            if near:
+                city.warn(
+                    'Stop {} is not tagged as a stop, {} is {:.0f} meters away',
+                    route.element, args=(el_id(el), near[0][1], near[0][0]),
+                )
+            else:
+                city.warn('Stop {} is not tagged as a stop', route.element, args=(el_id(el),))
+
+
+@rule
+class LineCounts(Rule):
+    name = 'line_counts'
+    masters = True
+
+    def __init__(self, city):
+        super().__init__(city)
+        self.modes = Counter()
+
+    def master(self, rmaster):
+        self.modes[rmaster.mode] += 1
+
+    def finish(self):
+        city = self.city
+        if not city.overground:
+            city.found_light_lines = sum(n for mode, n in self.modes.items() if mode != 'subway')
+            city.found_lines = self.modes['subway']
+            if city.found_lines != city.num_lines:
+                city.error(
+                    'Found {} subway lines, expected {}',
+                    args=(city.found_lines, city.num_lines),
+                )
+            if city.found_light_lines != city.num_light_lines:
+                city.error(
+                    'Found {} light rail lines, expected {}',
+                    args=(city.found_light_lines, city.num_light_lines),
+                )
+            return
+        city.found_tram_lines = self.modes['tram']
+        city.found_bus_lines = self.modes['bus']
+        city.found_trolleybus_lines = self.modes['trolleybus']
+        city.found_other_lines = sum(
+            n for mode, n in self.modes.items() if mode not in ('bus', 'trolleybus', 'tram')
+        )
+        if city.found_tram_lines != city.num_tram_lines:
+            city.error_if(
+                city.found_tram_lines == 0,
+                'Found {} tram lines, expected {}',
+                args=(city.found_tram_lines, city.num_tram_lines),
+            )
+
+
+@rule
+class Networks(Rule):
+    name = 'networks'
+    masters = True
+
+    def __init__(self, city):
+        super().__init__(city)
+        self.networks = Counter()
+
+    def master(self, rmaster):
+        self.networks[str(rmaster.network)] += 1
+
+    def finish(self):
+        city = self.city
+        city.found_networks = len(self.networks)
+        if len(self.networks) > max(1, len(city.networks)):
+            n_str = '; '.join(['{} ({})'.format(k, v) for k, v in sorted(self.networks.items())])
+            city.warn('More than one network: {}', args=(n_str,))
+
+
+@rule
+class Connectivity(Rule):
+    # Routes sharing a stop area or an interchange are connected; a network
+    # falling apart usually means missing stop areas or wrong stops
+    name = 'connectivity'
+    routes = True
+
+    def __init__(self, city):
+        super().__init__(city)
+        self.graph = UnionFind()  # Route ids joined through their stops
+        self.route_ids = []
+
+    def route(self, route):
+        if not len(route):
+            return
+        self.route_ids.append(route.route_id)
+        self.graph.add(route.route_id)
+        for stop in route.stops:
+            sa, transfer = self.city.groups.endpoint(stop)
+            self.graph.union(route.route_id, transfer or sa)
+
+    def finish(self):
+        city = self.city
+        components = Counter(self.graph.find(r) for r in self.route_ids)
+        isolated = ['r{}'.format(r) for r in self.route_ids if components[self.graph.find(r)] == 1]
+        city.network_components = len(components)
+        city.isolated_routes = len(isolated)
+        if len(components) > 1:
+            city.warn(
+                'Route network has {} disconnected parts, the largest has {} of {} routes',
+                args=(len(components), max(components.values()), len(self.route_ids)),
+            )
+        if isolated:
+            city.warn(
+                '{} routes share no stops with other routes: {}',
+                args=(len(isolated), format_elid_list(isolated)),
+            )
+
+
+def select_rules(names=None, skip=()):
+    # Names of rules to run: all by default, or those in names, minus skip
+    for name in list(names or ()) + list(skip):
+        if name not in RULES:
+            raise Exception('Unknown rule {}, known rules are: {}'.format(name, ', '.join(RULES)))
+    return [name for name in RULES if (not names or name in names) and name not in skip]
+
+
+def make_rules(city, names=None, building=False):
+    # Instances of the selected rules that apply to the city, either the
+    # building rules or the others
+    return [
+        RULES[name](city) for name in select_rules(names)
+        if RULES[name].overground in (None, city.overground) and RULES[name].building == building
+    ]
+
+
+def run_rules(city, names=None):
+    # Runs the rules in one pass: every element bucket any rule wants and
+    # the routes are walked once, feeding all rules interested in them.
+    # Issues of a previous run are replaced.
+    rules = make_rules(city, names)
+    by_kind = defaultdict(list)
+    for r in rules:
+        for kind in r.kinds:
+            by_kind[kind].append(r)
+    master_rules = [r for r in rules if r.masters]
+    route_rules = [r for r in rules if r.routes]
+    city.forget_issues('rules')
+    with city.collect_issues('rules'):
+        for kind, kind_rules in by_kind.items():
+            for el in city.iter_kind(kind):
+                for r in kind_rules:
+                    r.element(el, kind)
+        if master_rules or route_rules:
+            for rmaster in city.routes.values():
+                for r in master_rules:
+                    r.master(rmaster)
+                for route in rmaster:
+                    for r in route_rules:
+                        r.route(route)
+        for r in rules:
+            r.finish()
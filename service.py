@@ -0,0 +1,233 @@
+import io
+import json
+import logging
+import os
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree.ElementTree import ParseError
+
+from metrics import Metrics
+from osm_reader import iter_json_elements, iter_osm_change, iter_xml_elements
+from validation import apply_changes, make_city, revalidation, validation
+
+MAX_BODY = 512 * 1024 * 1024  # bytes of a snapshot or a change file
+
+
+class NotFound(Exception):
+    pass
+
+
+class CityStore:
+    # Validated cities kept in memory between requests. A city is loaded
+    # from a snapshot once; later snapshots and change files only rebuild
+    # changed routes. Every city has a lock, so queries wait for an update
+    # of their city but not of others.
+    def __init__(self, rules=None, max_issues=None):
+        self.rules = rules
+        self.max_issues = max_issues
+        self.cities = {}  # City id → City
+        self.results = {}  # City id → validation result, until the city changes
+        self.locks = {}  # City id → Lock
+        self.lock = threading.Lock()
+
+    def city_lock(self, city_id):
+        with self.lock:
+            return self.locks.setdefault(city_id, threading.Lock())
+
+    def city(self, city_id):
+        city = self.cities.get(city_id)
+        if city is None:
+            raise NotFound('City {} is not loaded'.format(city_id))
+        return city
+
+    def update(self, city_id, update, metrics):
+        # A city that failed halfway is dropped, the next snapshot loads it anew
+        try:
+            self.cities[city_id] = update(self.cities.get(city_id), metrics)
+        except BaseException:
+            self.cities.pop(city_id, None)
+            raise
+        finally:
+            self.results.pop(city_id, None)
+        return metrics.summary()
+
+    def load(self, city_id, elements):
+        # Validates a city, or revalidates it when it is loaded already
+        def update(city, metrics):
+            if city is not None:
+                return revalidation(city, elements, metrics)
+            city = make_city(city_id)
+            city.rules = self.rules
+            if self.max_issues:
+                city.max_issues = self.max_issues
+            return validation(city, elements, metrics)
+
+        with self.city_lock(city_id):
+            return self.update(city_id, update, Metrics(city_id))
+
+    def apply(self, city_id, changes):
+        # Applies (action, element) pairs of an osmChange file
+        with self.city_lock(city_id):
+            self.city(city_id)
+            return self.update(city_id, lambda city, metrics: apply_changes(city, changes, metrics), Metrics(city_id))
+
+    def list(self):
+        # Every city is read under its lock, an update may be running
+        with self.lock:
+            city_ids = list(self.cities)
+        cities = []
+        for city_id in city_ids:
+            with self.city_lock(city_id):
+                city = self.cities.get(city_id)
+                if city is not None:
+                    cities.append({
+                        'id': city.id, 'name': city.name, 'routes': len(city.route_by_id), 'good': city.is_good(),
+                    })
+        return cities
+
+    def result(self, city_id):
+        with self.city_lock(city_id):
+            city = self.city(city_id)
+            if city_id not in self.results:
+                self.results[city_id] = city.get_validation_result()
+            return self.results[city_id]
+
+    def issues(self, city_id, level=None):
+        with self.city_lock(city_id):
+            records = self.city(city_id).issue_records()
+            return [r for r in records if level is None or r['level'] == level]
+
+    def route(self, city_id, route_id):
+        with self.city_lock(city_id):
+            city = self.city(city_id)
+            route = city.route_by_id.get(route_id)
+            if route is None:
+                raise NotFound('Route {} is not in city {}'.format(route_id, city_id))
+            master_id = city.groups.group_of[route_id][0]
+            bucket = city.element_issues.get(route_id)
+            return {
+                'id': route_id,
+                'route': route.route,
+                'ref': route.ref,
+                'name': route.name,
+                'network': route.network,
+                'route_master': master_id if master_id and master_id > 0 else None,
+                'stops': list(route.stops),
+                'warnings': [str(i) for i in bucket.warnings] if bucket else [],
+                'errors': [str(i) for i in bucket.errors] if bucket else [],
+            }
+
+
+class Handler(BaseHTTPRequestHandler):
+    # GET  /cities                           loaded cities
+    # GET  /cities/<id>                      validation result of a city
+    # GET  /cities/<id>/issues[?level=error] issue records of a city
+    # GET  /cities/<id>/routes/<route id>    stops and issues of a route
+    # POST /cities/<id>                      Overpass JSON or OSM XML snapshot
+    # POST /cities/<id>/changes              osmChange file
+    server_version = 'BusValidation'
+    paths = [
+        ('GET', re.compile(r'/cities'), 'get_cities'),
+        ('GET', re.compile(r'/cities/(\d+)'), 'get_city'),
+        ('GET', re.compile(r'/cities/(\d+)/issues'), 'get_issues'),
+        ('GET', re.compile(r'/cities/(\d+)/routes/(\d+)'), 'get_route'),
+        ('POST', re.compile(r'/cities/(\d+)'), 'post_snapshot'),
+        ('POST', re.compile(r'/cities/(\d+)/changes'), 'post_changes'),
+    ]
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logging.info('%s %s', self.address_string(), format % args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        start = time.perf_counter()
+        path, _, query = self.path.partition('?')
+        for m, pattern, name in self.paths:
+            match = pattern.fullmatch(path.rstrip('/'))
+            if m == method and match:
+                break
+        else:
+            return self.send_json(404, {'error': 'No such path: {} {}'.format(method, path)})
+        params = dict(p.partition('=')[::2] for p in query.split('&') if p)
+        try:
+            data = getattr(self, name)(*(int(g) for g in match.groups()), **params)
+        except NotFound as e:
+            return self.send_json(404, {'error': str(e)})
+        except (ValueError, KeyError, TypeError, ParseError) as e:
+            logging.exception('Bad request %s %s', method, path)
+            return self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            logging.exception('Failed to serve %s %s', method, path)
+            return self.send_json(500, {'error': str(e)})
+        self.send_json(200, data, time.perf_counter() - start)
+
+    def send_json(self, status, data, seconds=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if seconds is not None:
+            self.send_header('X-Seconds', '{:.6f}'.format(seconds))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not 0 < length <= MAX_BODY:
+            raise ValueError('Content-Length must be between 1 and {}'.format(MAX_BODY))
+        return io.BytesIO(self.rfile.read(length))
+
+    def is_xml(self):
+        return 'xml' in self.headers.get('Content-Type', '')
+
+    def get_cities(self):
+        return self.server.store.list()
+
+    def get_city(self, city_id):
+        return self.server.store.result(city_id)
+
+    def get_issues(self, city_id, level=None):
+        return self.server.store.issues(city_id, level)
+
+    def get_route(self, city_id, route_id):
+        return self.server.store.route(city_id, route_id)
+
+    def post_snapshot(self, city_id):
+        f = self.body()
+        if self.is_xml():
+            elements = iter_xml_elements(f)
+        else:
+            elements = iter_json_elements(io.TextIOWrapper(f, encoding='utf-8'))
+        return self.server.store.load(city_id, elements)
+
+    def post_changes(self, city_id):
+        return self.server.store.apply(city_id, iter_osm_change(self.body()))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(address, store):
+    # address is host:port, or a path of a Unix socket
+    if ':' in address and not address.startswith(('/', '.')):
+        host, _, port = address.rpartition(':')
+        server = ThreadingHTTPServer((host, int(port)), Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixHTTPServer(address, Handler)
+    server.store = store
+    return server
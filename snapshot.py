@@ -0,0 +1,216 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b'BUSSNAP\0'
+FORMAT_VERSION = 3
+# Route tags kept in a snapshot, in column order; enough to rebuild a Route
+ROUTE_TAGS = ('type', 'route', 'name', 'ref', 'network', 'operator', 'public_transport:version', 'from', 'to')
+# Tags of route_master relations, in column order
+MASTER_TAGS = ('route_master', 'name', 'ref', 'network')
+STOP_AREA_TAGS = {'type': 'public_transport', 'public_transport': 'stop_area'}
+STOP_AREA_GROUP_TAGS = {'type': 'public_transport', 'public_transport': 'stop_area_group'}
+HEADER = struct.Struct('<8sIIqi4x')  # magic, format version, section count, city id, city name
+SECTION = struct.Struct('<QQ')  # offset, length in bytes
+# Sections in file order with their array typecodes
+SECTIONS = (
+    ('string_offsets', 'I'),  # n_strings + 1 offsets into string_data
+    ('string_data', 'B'),  # UTF-8 of all strings back to back
+    ('route_ids', 'q'),
+    ('route_tags', 'i'),  # n_routes × len(ROUTE_TAGS) string indices, -1 for a missing tag
+    ('route_masters', 'i'),  # index into master_ids for every route
+    ('route_members', 'B'),  # 1 for a route read with its members, 0 for one read with tags only
+    ('stop_offsets', 'I'),  # n_routes + 1 offsets into stop_ids
+    ('stop_ids', 'q'),  # node ids of route stops
+    ('master_ids', 'q'),  # route_master relation id of every route master, 0 for a group without one
+    ('master_tags', 'i'),  # n_masters × len(MASTER_TAGS) string indices, -1 for a missing tag
+    ('stop_area_ids', 'q'),  # relation ids of stop areas with route stops
+    ('stop_area_offsets', 'I'),  # n_stop_areas + 1 offsets into stop_area_stops
+    ('stop_area_stops', 'q'),  # node ids of route stops in every stop area
+    ('transfer_groups', 'q'),  # stop_area_group relation id of every transfer
+    ('transfer_offsets', 'I'),  # n_transfers + 1 offsets into transfer_ids
+    ('transfer_ids', 'q'),  # relation ids of stop areas in transfers
+)
+
+
+class StringTable:
+    def __init__(self):
+        self.index = {}
+        self.offsets = array('I', [0])
+        self.data = bytearray()
+
+    def add(self, s):
+        if s is None:
+            return -1
+        if s not in self.index:
+            self.index[s] = len(self.index)
+            self.data += s.encode('utf-8')
+            self.offsets.append(len(self.data))
+        return self.index[s]
+
+
+def stop_area_id(sa):
+    # Stop areas in transfers are StopArea objects or el_id strings like 'r123'
+    sa_id = getattr(sa, 'id', sa)
+    return int(sa_id[1:]) if isinstance(sa_id, str) else int(sa_id)
+
+
+def write_snapshot(city, path):
+    if sys.byteorder != 'little':
+        raise Exception('Snapshots are little-endian only')
+    strings = StringTable()
+    name = strings.add(city.name)
+    data = {name_: array(typecode) for name_, typecode in SECTIONS}
+    for section in ('stop_offsets', 'stop_area_offsets', 'transfer_offsets'):
+        data[section].append(0)
+    for master_index, rmaster in enumerate(city.routes.values()):
+        tags = rmaster.relation.get('tags', {}) if rmaster.relation else {}
+        data['master_ids'].append(rmaster.relation['id'] if rmaster.relation else 0)
+        data['master_tags'].extend(strings.add(tags.get(k)) for k in MASTER_TAGS)
+        for route in rmaster:
+            data['route_ids'].append(route.route_id)
+            data['route_tags'].extend(strings.add(v) for v in (
+                route.type, route.route, route.name, route.ref, route.network,
+                route.operator, route.version, route.route_from, route.route_to,
+            ))
+            data['route_masters'].append(master_index)
+            # Relations read without members are not in city.elements
+            data['route_members'].append('r{}'.format(route.route_id) in city.elements)
+            data['stop_ids'].extend(route.stops)
+            data['stop_offsets'].append(len(data['stop_ids']))
+    # Stop areas keep only the route stops, in the order the city has them,
+    # so that every stop gets the same first stop area back
+    stops = set(data['stop_ids'])
+    for sa in city.iter_kind('stop_area'):
+        sa_stops = [m['ref'] for m in sa['members'] if m['type'] == 'node' and m['ref'] in stops]
+        if sa_stops:
+            data['stop_area_ids'].append(sa['id'])
+            data['stop_area_stops'].extend(sa_stops)
+            data['stop_area_offsets'].append(len(data['stop_area_stops']))
+    group_of = {}  # Stop area el_id → id of the first stop_area_group it is in
+    for sag in city.iter_kind('stop_area_group'):
+        for m in sag['members']:
+            group_of.setdefault('{}{}'.format(m['type'][0], m['ref']), sag['id'])
+    for transfer in city.transfers:
+        data['transfer_groups'].append(group_of[transfer[0]])
+        data['transfer_ids'].extend(stop_area_id(sa) for sa in transfer)
+        data['transfer_offsets'].append(len(data['transfer_ids']))
+    data['string_offsets'] = strings.offsets
+    data['string_data'] = array('B', bytes(strings.data))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(SECTIONS), city.id, name))
+        table_offset = f.tell()
+        f.write(b'\0' * SECTION.size * len(SECTIONS))
+        table = []
+        for name_, _ in SECTIONS:
+            # Sections are 8-byte aligned, so they can be cast in place
+            f.write(b'\0' * (-f.tell() % 8))
+            table.append((f.tell(), len(data[name_]) * data[name_].itemsize))
+            data[name_].tofile(f)
+        f.seek(table_offset)
+        for offset, length in table:
+            f.write(SECTION.pack(offset, length))
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+    # A memory-mapped snapshot. Arrays are memoryviews over the mapping,
+    # nothing is read or decoded until it is used.
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise Exception('Snapshots are little-endian only')
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, self.city_id, name = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception('{} is not a city snapshot'.format(path))
+        if version != FORMAT_VERSION or count != len(SECTIONS):
+            raise Exception('Snapshot {} has format version {}, expected {}'.format(path, version, FORMAT_VERSION))
+        view = memoryview(self.mm)
+        for i, (section, typecode) in enumerate(SECTIONS):
+            offset, length = SECTION.unpack_from(self.mm, HEADER.size + i * SECTION.size)
+            setattr(self, section, view[offset:offset + length].cast(typecode))
+        self.strings = {}
+        self.city_name = self.string(name)
+
+    def close(self):
+        for section, _ in SECTIONS:
+            getattr(self, section).release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.route_ids)
+
+    def string(self, i):
+        if i < 0:
+            return None
+        s = self.strings.get(i)
+        if s is None:
+            s = self.strings[i] = bytes(
+                self.string_data[self.string_offsets[i]:self.string_offsets[i + 1]]
+            ).decode('utf-8')
+        return s
+
+    def tags(self, i):
+        row = self.route_tags[i * len(ROUTE_TAGS):(i + 1) * len(ROUTE_TAGS)]
+        return {k: self.string(v) for k, v in zip(ROUTE_TAGS, row) if v >= 0}
+
+    def master(self, i):
+        # Tags of the route_master relation of master i
+        row = self.master_tags[i * len(MASTER_TAGS):(i + 1) * len(MASTER_TAGS)]
+        tags = {k: self.string(v) for k, v in zip(MASTER_TAGS, row) if v >= 0}
+        tags['type'] = 'route_master'
+        return tags
+
+    def stops(self, i):
+        return self.stop_ids[self.stop_offsets[i]:self.stop_offsets[i + 1]]
+
+    def transfers(self):
+        for i in range(len(self.transfer_offsets) - 1):
+            yield self.transfer_ids[self.transfer_offsets[i]:self.transfer_offsets[i + 1]]
+
+    def elements(self):
+        # Relations in the shape validation() reads from OSM data: route
+        # masters first, so routes are grouped as they come, stop areas of
+        # route stops, routes, and a stop_area_group for every transfer
+        masters = {}  # Master index → route ids
+        for i in range(len(self)):
+            if self.master_ids[self.route_masters[i]]:
+                masters.setdefault(self.route_masters[i], []).append(self.route_ids[i])
+        for m, route_ids in masters.items():
+            yield {
+                'type': 'relation',
+                'id': self.master_ids[m],
+                'tags': self.master(m),
+                'members': [{'type': 'relation', 'ref': r, 'role': ''} for r in route_ids],
+            }
+        for i in range(len(self.stop_area_ids)):
+            stops = self.stop_area_stops[self.stop_area_offsets[i]:self.stop_area_offsets[i + 1]]
+            yield {
+                'type': 'relation',
+                'id': self.stop_area_ids[i],
+                'tags': dict(STOP_AREA_TAGS),
+                'members': [{'type': 'node', 'ref': n, 'role': 'stop'} for n in stops],
+            }
+        for i in range(len(self)):
+            route = {'type': 'relation', 'id': self.route_ids[i], 'tags': self.tags(i)}
+            if self.route_members[i]:
+                route['members'] = [{'type': 'node', 'ref': n, 'role': 'stop'} for n in self.stops(i)]
+            yield route
+        for i, transfer in enumerate(self.transfers()):
+            yield {
+                'type': 'relation',
+                'id': self.transfer_groups[i],
+                'tags': dict(STOP_AREA_GROUP_TAGS),
+                'members': [{'type': 'relation', 'ref': sa, 'role': ''} for sa in transfer],
+            }
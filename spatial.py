@@ -0,0 +1,86 @@
+import math
+from collections import defaultdict
+
+EARTH_RADIUS = 6378137.0  # in meters
+
+
+class GridIndex:
+    # Points bucketed into square cells of cell_size meters on an
+    # equirectangular plane around lat0. A radius query looks only at the
+    # cells the circle touches, so lookups do not depend on the point count
+    # as long as cell_size is close to the usual query radius.
+    def __init__(self, cell_size, lat0):
+        self.cell_size = float(cell_size)
+        self.kx = math.radians(1) * EARTH_RADIUS * math.cos(math.radians(lat0))
+        self.ky = math.radians(1) * EARTH_RADIUS
+        self.cells = defaultdict(list)
+        self.bounds = None  # (min cx, min cy, max cx, max cy) of non-empty cells
+
+    def __len__(self):
+        return sum(len(c) for c in self.cells.values())
+
+    def cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def insert(self, key, lon, lat):
+        x, y = lon * self.kx, lat * self.ky
+        cx, cy = self.cell(x, y)
+        self.cells[(cx, cy)].append((key, x, y))
+        if self.bounds is None:
+            self.bounds = (cx, cy, cx, cy)
+        else:
+            b = self.bounds
+            self.bounds = (min(b[0], cx), min(b[1], cy), max(b[2], cx), max(b[3], cy))
+
+    def within(self, lon, lat, radius):
+        # List of (distance, key) of points not farther than radius, nearest first
+        x, y = lon * self.kx, lat * self.ky
+        cx, cy = self.cell(x, y)
+        r = int(math.ceil(radius / self.cell_size))
+        found = []
+        for i in range(cx - r, cx + r + 1):
+            for j in range(cy - r, cy + r + 1):
+                for key, px, py in self.cells.get((i, j), ()):
+                    d = math.hypot(px - x, py - y)
+                    if d <= radius:
+                        found.append((d, key))
+        found.sort(key=lambda t: t[0])
+        return found
+
+    def ring(self, cx, cy, k):
+        if k == 0:
+            yield cx, cy
+            return
+        for i in range(cx - k, cx + k + 1):
+            yield i, cy - k
+            yield i, cy + k
+        for j in range(cy - k + 1, cy + k):
+            yield cx - k, j
+            yield cx + k, j
+
+    def nearest(self, lon, lat, max_distance=None):
+        # (distance, key) of the nearest point, or None. Rings of cells are
+        # examined outwards until no closer point can be found.
+        if self.bounds is None:
+            return None
+        x, y = lon * self.kx, lat * self.ky
+        cx, cy = self.cell(x, y)
+        b = self.bounds
+        max_ring = max(cx - b[0], b[2] - cx, cy - b[1], b[3] - cy)
+        best = None
+        k = 0
+        while k <= max_ring:
+            # Points in farther rings are at least this far away
+            if best is not None and best[0] <= (k - 1) * self.cell_size:
+                break
+            if max_distance is not None and (k - 1) * self.cell_size > max_distance:
+                break
+            for cell in self.ring(cx, cy, k):
+                for key, px, py in self.cells.get(cell, ()):
+                    d = math.hypot(px - x, py - y)
+                    if best is None or d < best[0]:
+                        best = (d, key)
+            k += 1
+        if best is None or (max_distance is not None and best[0] > max_distance):
+            return None
+        return best
@@ -0,0 +1,81 @@
+from collections import defaultdict
+
+
+class UnionFind:
+    # Disjoint sets of hashable items, union by size with path halving
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def __contains__(self, x):
+        return x in self.parent
+
+    def add(self, x):
+        if x not in self.parent:
+            self.parent[x] = x
+            self.size[x] = 1
+
+    def find(self, x):
+        self.add(x)
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
+
+
+def stop_area_ids(city, stop):
+    return ['r{}'.format(sa['id']) for sa in city.stop_areas.get('n{}'.format(stop), ())]
+
+
+def is_stop_area(el):
+    tags = el.get('tags', {})
+    return el['type'] == 'relation' and tags.get('type') == 'public_transport' and tags.get('public_transport') == 'stop_area'
+
+
+def group_stop_areas(city, sag):
+    # El_ids of the stop areas of a stop_area_group that are in the city.
+    # A member may validly not belong to the city while the group does,
+    # near the city bbox boundary.
+    for m in sag['members']:
+        k = '{}{}'.format(m['type'][0], m['ref'])
+        el = city.elements.get(k)
+        if el and is_stop_area(el):
+            yield k
+
+
+def find_transfers(city):
+    # Stop areas of a stop_area_group make an interchange, and groups that
+    # share a stop area make one interchange together. Sets
+    # city.interchanges and city.transfers, the interchanges of two or more
+    # stop areas used by routes. Problems with the groups are reported by
+    # the interchanges rule.
+    interchanges = UnionFind()
+    group_of = {}  # El_id of stop area → el_id of the first group it is in
+    for sag in city.iter_kind('stop_area_group'):
+        sag_id = 'r{}'.format(sag['id'])
+        for k in group_stop_areas(city, sag):
+            group_of.setdefault(k, sag_id)
+            interchanges.union(sag_id, k)
+    city.interchanges = interchanges
+
+    used = set()
+    for route in city.route_by_id.values():
+        for stop in route.stops:
+            used.update(stop_area_ids(city, stop))
+    transfers = defaultdict(list)
+    for k in group_of:
+        if k in used:
+            transfers[interchanges.find(k)].append(k)
+    city.transfers = [t for t in transfers.values() if len(t) > 1]
@@ -8,30 +8,229 @@ import time
 import urllib.parse
 import urllib.request
 
-from route import Route, RouteMaster
+from cache import elements_digest
+from chain import chain_route
+from city import City, el_id, element_kinds
+from metrics import Metrics
+from route import Route
+from transfers import find_transfers
+from rules import make_rules, run_rules
 
 
-def validation(city, osm):
-    print('this is a validation')
-    route_master_list = {}
-    route_list = []
+def make_city(city_id, name=''):
+    # A bus-only city row for City.__init__ without expected line counts
+    return City([city_id, name, '', '', '0', '0', '0', '0', '', 'bus:'], overground=True)
+
+
+def element_version(el):
+    # Overpass "out tags" has no versions, fall back to a digest of the content
+    if 'version' in el:
+        return el['version']
+    return elements_digest([el])
+
+
+def add_route(city, item, metrics=None):
+    # Issues of the route are kept apart, so they can be dropped when the
+    # relation changes
+    metrics = metrics or Metrics()
+    with metrics.span('route_construction'):
+        with city.collect_issues(item['id']):
+            route = Route(item['id'], item['tags'], city)
+            # A partition worker checked the line already, see partition.py
+            for is_error, code, message, args in item.get('line_issues', ()):
+                city.log(is_error, message, route.element, args, code)
+        city.route_by_id[item['id']] = route
+        city.versions[item['id']] = element_version(item)
+    with metrics.span('route_master_grouping'):
+        city.groups.add(route)
+    return route
+
+
+def remove_route(city, route_id):
+    route = city.route_by_id.pop(route_id)
+    del city.versions[route_id]
+    city.forget_issues(route_id)
+    city.groups.remove(route)
+
+
+def chain_routes(city, route_ids, metrics):
+    # Runs once all elements are in, since ways and nodes of a route may
+    # come after its relation. Building rules check every route here, their
+    # issues are kept with the route.
+    rules = make_rules(city, city.rules, building=True)
+    with metrics.span('way_chains'):
+        for route_id in route_ids:
+            route = city.route_by_id[route_id]
+            relation = city.elements.get('r{}'.format(route_id))
+            with city.collect_issues(route_id):
+                chain = chain_route(city, route, relation) if relation is not None else None
+                for r in rules:
+                    r.built(route, chain)
+
+
+def routes_with_members(city, keys):
+    # Ids of routes with a member among the el_ids in keys, e.g. changed
+    # ways and stops; their chains have to be built again
+    result = []
+    for route_id in city.route_by_id:
+        relation = city.elements.get('r{}'.format(route_id))
+        if relation and any(el_id(m) in keys for m in relation['members']):
+            result.append(route_id)
+    return result
+
+
+def is_city_route(city, item):
+    # Route relations of other modes, under construction or without a ref
+    # and a name are left out
+    return item['id'] != city.id and Route.is_route(item, city.modes)
+
+
+def validation(city, osm, metrics=None):
+    if not isinstance(city, City):
+        city = make_city(city)
+    logging.debug('Validating city %s', city.id)
+    metrics = metrics or Metrics(city.id)
+    count = 0
     
-    for item in osm:
+    # osm may be a generator, elements are consumed one by one,
+    # time spent reading them is counted as parse
+    for item in metrics.timed('parse', osm):
+        count += 1
+        if item['type'] != 'area':
+            # Members and geometry, when the query asked for them
+            city.add(item)
         if item['type'] == 'area':
             logging.info('City:{}'.format(item['tags']['name']))
+            if not city.name:
+                city.name = item['tags']['name']
         elif item['type'] == 'relation':
-            if item['id'] == city:
-                print('cnm')
+            if item['id'] == city.id:
+                logging.debug('Skipping the city relation %s', item['id'])
                 continue
-            if item['tags']['type'] == 'route':
-                route_list.append(Route(item['id'], item['tags'], None))
-          
-    for route in route_list:
-        # print(route)
-        if route.ref not in route_master_list:
-            route_master_list[route.ref] = RouteMaster(route.ref, None, city)
-        route_master_list[route.ref].routes.append(route)
-
-    for ref in route_master_list:
-        print(route_master_list[ref])
-        
\ No newline at end of file
+            if is_city_route(city, item):
+                add_route(city, item, metrics)
+            elif item.get('tags', {}).get('type') == 'route_master':
+                city.groups.update_master(item)
+    logging.info('Read %s elements', count)
+    chain_routes(city, list(city.route_by_id), metrics)
+    with metrics.span('transfers'):
+        find_transfers(city)
+    metrics.count('routes', len(city.route_by_id))
+    metrics.count('route_masters', len(city.routes))
+    with metrics.span('rules'):
+        run_rules(city, city.rules)
+    return city
+
+
+def revalidation(city, osm, metrics=None):
+    # Updates a city returned by validation() to a new snapshot: only route
+    # relations that were added, removed or got a new version are rebuilt.
+    # Other elements missing from the snapshot are dropped from the city.
+    metrics = metrics or Metrics(city.id)
+    seen = set()
+    seen_elements = set()  # El_ids of all elements in the snapshot
+    touched = set()  # El_ids of changed or deleted nodes and ways
+    changed = []
+    masters = []  # Changed route_masters, their routes may move to other groups
+    for item in metrics.timed('parse', osm):
+        if item['type'] != 'area':
+            k = el_id(item)
+            seen_elements.add(k)
+            if city.elements.get(k) != item:
+                city.remove(k)
+                city.add(item)
+                if item['type'] != 'relation':
+                    touched.add(k)
+                if item['type'] == 'relation' and item.get('tags', {}).get('type') == 'route_master':
+                    masters.append(item)
+        if not is_city_route(city, item):
+            continue
+        seen.add(item['id'])
+        if city.versions.get(item['id']) != element_version(item):
+            changed.append(item)
+    removed = [r for r in city.versions if r not in seen]
+    gone = [k for k in city.elements if k not in seen_elements]
+    # Routes of a deleted route_master go back to their own groups
+    masters.extend(city.elements[k] for k in gone if 'route_master' in element_kinds(city.elements[k]))
+    touched.update(k for k in gone if k[0] != 'r')
+    if touched:
+        # Routes whose ways or stops changed are rebuilt from their relation
+        rebuilt = {item['id'] for item in changed}
+        rebuilt.update(removed)
+        changed.extend(
+            city.elements['r{}'.format(route_id)]
+            for route_id in routes_with_members(city, touched) if route_id not in rebuilt
+        )
+    city.remove(*gone)
+    logging.info('%s routes changed, %s removed, %s other elements removed', len(changed), len(removed), len(gone))
+    metrics.count('routes_changed', len(changed))
+    metrics.count('routes_removed', len(removed))
+    metrics.count('elements_removed', len(gone))
+
+    with metrics.span('route_removal'):
+        for route_id in removed:
+            remove_route(city, route_id)
+        for item in changed:
+            if item['id'] in city.route_by_id:
+                remove_route(city, item['id'])
+    for item in changed:
+        add_route(city, item, metrics)
+    chain_routes(city, [item['id'] for item in changed], metrics)
+    with metrics.span('transfers'):
+        find_transfers(city)
+    for item in masters:
+        city.groups.update_master(item)
+    with metrics.span('rules'):
+        run_rules(city, city.rules)
+    return city
+
+
+def apply_changes(city, changes, metrics=None):
+    # Updates a city returned by validation() with (action, element) pairs
+    # of an osmChange file. Changed and deleted routes are rebuilt, and so
+    # are routes with a changed way or stop.
+    metrics = metrics or Metrics(city.id)
+    changed = {}  # Route id → relation to build the route from
+    rebuilt = set()  # Ids of routes to remove first
+    masters = []
+    touched = set()  # El_ids of changed nodes and ways
+    for action, item in metrics.timed('parse', changes):
+        k = el_id(item)
+        # A modified relation is taken out first, so that route_master and
+        # stop_area lookups do not keep its old members
+        city.remove(k)
+        if action != 'delete':
+            city.add(item)
+        if item['type'] != 'relation':
+            touched.add(k)
+            continue
+        # A deleted route_master may come without tags
+        if item.get('tags', {}).get('type') == 'route_master' or item['id'] in city.groups.master_routes:
+            masters.append(item)
+        if item['id'] in city.route_by_id:
+            rebuilt.add(item['id'])
+        if action != 'delete' and is_city_route(city, item):
+            changed[item['id']] = item
+        else:
+            changed.pop(item['id'], None)
+    if touched:
+        for route_id in routes_with_members(city, touched):
+            if route_id not in rebuilt:
+                rebuilt.add(route_id)
+                changed[route_id] = city.elements['r{}'.format(route_id)]
+    logging.info('%s routes changed, %s removed', len(changed), len(rebuilt) - len(rebuilt & set(changed)))
+    metrics.count('routes_changed', len(changed))
+
+    with metrics.span('route_removal'):
+        for route_id in rebuilt:
+            remove_route(city, route_id)
+    for item in changed.values():
+        add_route(city, item, metrics)
+    chain_routes(city, list(changed), metrics)
+    for item in masters:
+        city.groups.update_master(item)
+    with metrics.span('transfers'):
+        find_transfers(city)
+    with metrics.span('rules'):
+        run_rules(city, city.rules)
+    return city
@@ -0,0 +1,32 @@
+import json
+
+
+class ValidationLog:
+    # Writes one NDJSON line per city as soon as it is validated. With
+    # issues=True every warning and error gets a line of its own, and the
+    # city line carries only their counts.
+    def __init__(self, f, issues=False):
+        self.f = f
+        self.issues = issues
+
+    def write_line(self, record):
+        self.f.write(json.dumps(record, ensure_ascii=False))
+        self.f.write('\n')
+
+    def write(self, result, issues=None):
+        record = {'record': 'city'}
+        record.update(result)
+        if self.issues and issues is not None:
+            record['warnings'] = sum(1 for i in issues if i['level'] == 'warning')
+            record['errors'] = len(issues) - record['warnings']
+        self.write_line(record)
+        if self.issues and issues is not None:
+            for issue in issues:
+                line = {'record': 'issue', 'city': result['id']}
+                line.update(issue)
+                self.write_line(line)
+        self.f.flush()
+
+    def write_city(self, city):
+        issues = list(city.issue_records()) if self.issues else None
+        self.write(city.get_validation_result(), issues)